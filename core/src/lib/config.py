@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Literal
 
 import toml
 
@@ -52,6 +53,44 @@ class Config:
     max_mangadex_requests_per_second: int
     max_bakaupdate_requests_per_second: int
 
+    num_ocr_workers: int = 1
+    num_llm_workers: int = 1
+    num_import_workers: int = 1
+    num_proxy_workers: int = 1
+
+    run_job_workers: bool = True
+    job_poll_seconds: float = 1
+
+    ocr_job_timeout_seconds: float = 600
+    llm_job_timeout_seconds: float = 600
+    import_job_timeout_seconds: float = 3600
+    proxy_job_timeout_seconds: float = 120
+
+    model_memory_budget_mb: int = 0
+    model_eviction_policy: Literal["lru", "cost"] = "cost"
+    model_idle_unload_seconds: float = 0
+
+    ocr_batch_size: int = 8
+    ocr_max_batch_pages: int = 4
+    ocr_max_batch_delay_seconds: float = 0.5
+
+    ocr_backend: Literal["torch", "onnx", "onnx_int8"] = "torch"
+    ocr_onnx_folder: str = "data/models/onnx"
+
+    ocr_blank_max_std: float = 4
+    ocr_blank_min_edge_density: float = 0.02
+
+    ocr_partial_results: bool = False
+
+    ocr_dedupe_min_overlap: float = 0.7
+
+    ocr_prefetch: bool = True
+    ocr_prefetch_max_workers: int = 1
+
+    ocr_reco_bucket_size: int = 64
+
+    model_load_timeout_seconds: float = 0
+
     @classmethod
     def load(cls, data: dict) -> "Config":
         d = data.copy()
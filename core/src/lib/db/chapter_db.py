@@ -1,13 +1,13 @@
-import hashlib
 import sqlite3
 from pathlib import Path
 from typing import TypeAlias
 from uuid import uuid4
 
-import numpy as np
-from comic_ocr.lib.label_utils import StitchedBlock
 from PIL import Image
 
+from ..page_images import hash_pixels, open_page
+from .migrations import run_migrations
+
 ChapterDb: TypeAlias = sqlite3.Connection
 
 CHAPTER_DB_FILENAME = "_reader_chapter.sqlite"
@@ -76,11 +76,11 @@ def select_page(db: ChapterDb, filename: str) -> dict | None:
     return dict(r) if r else None
 
 
-def insert_page(db: ChapterDb, fp: Path) -> dict:
-    im = Image.open(fp)
+def insert_page(db: ChapterDb, fp: Path, im: Image.Image | None = None) -> dict:
+    # im is the already opened image, if any, so that it's only decoded once
+    im = im or open_page(fp)
 
-    arr = np.array(im).astype(np.uint8)
-    sha256 = hashlib.sha256(arr.tobytes()).hexdigest()
+    sha256 = hash_pixels(im)
 
     width, height = im.size
 
@@ -106,7 +106,8 @@ def insert_page(db: ChapterDb, fp: Path) -> dict:
     return data
 
 
-def select_ocr_data(db: ChapterDb, filename: str) -> dict | None:
+def select_ocr_data(db: ChapterDb, filename: str, partial=False) -> dict | None:
+    # partial also returns the blocks found so far for pages that are still being OCR'd
     page_data = db.execute(
         """
         SELECT done_ocr
@@ -116,7 +117,7 @@ def select_ocr_data(db: ChapterDb, filename: str) -> dict | None:
         [filename],
     ).fetchone()
 
-    if not page_data or not page_data["done_ocr"]:
+    if not page_data or not (page_data["done_ocr"] or partial):
         return None
 
     rs = db.execute(
@@ -139,10 +140,16 @@ def select_ocr_data(db: ChapterDb, filename: str) -> dict | None:
     }
 
 
-def insert_ocr_data(db: ChapterDb, filename: str, block: StitchedBlock) -> dict | None:
+def insert_ocr_block(
+    db: ChapterDb,
+    filename: str,
+    value: str,
+    confidence: float,
+    bbox: tuple[int, int, int, int],
+) -> dict | None:
     id = uuid4().hex
-    value = block.value.replace("\n", " ")
-    y1, x1, y2, x2 = block.bbox
+    value = value.replace("\n", " ")
+    y1, x1, y2, x2 = bbox
 
     r = db.execute(
         """
@@ -152,10 +159,33 @@ def insert_ocr_data(db: ChapterDb, filename: str, block: StitchedBlock) -> dict
             ?, ?, ?, ?, ?, ?, ?, ? 
         )
         """,
-        [id, filename, value, block.confidence, x1, x2, y1, y2],
+        [id, filename, value, confidence, x1, x2, y1, y2],
     ).fetchone()
 
 
+def bump_ocr_version(db: ChapterDb, filename: str):
+    db.execute(
+        """
+        UPDATE pages
+        SET ocr_version = ocr_version + 1
+        WHERE filename = ?
+        """,
+        [filename],
+    )
+
+
+def _bump_block_ocr_version(db: ChapterDb, block_id: str):
+    # Same as bump_ocr_version() for the page that the block is on
+    db.execute(
+        """
+        UPDATE pages
+        SET ocr_version = ocr_version + 1
+        WHERE filename = (SELECT filename FROM ocr_data WHERE id = ?)
+        """,
+        [block_id],
+    )
+
+
 def update_ocr_text(db: ChapterDb, id: str, value: str) -> dict | None:
     db.execute(
         """
@@ -165,11 +195,15 @@ def update_ocr_text(db: ChapterDb, id: str, value: str) -> dict | None:
         """,
         [value, id],
     ).fetchone()
+    _bump_block_ocr_version(db, id)
 
     db.commit()
 
 
 def delete_ocr_data(db: ChapterDb, id: str) -> dict | None:
+    # (before the block's gone, since it's how the page is found)
+    _bump_block_ocr_version(db, id)
+
     db.execute(
         """
         DELETE FROM ocr_data
@@ -182,10 +216,18 @@ def delete_ocr_data(db: ChapterDb, id: str) -> dict | None:
 
 
 def _check_version(db: ChapterDb):
-    r = db.execute("SELECT version FROM metadata").fetchone()
-    if r is None:
-        db.execute("INSERT INTO metadata (version) VALUES (?)", ["1"])
-        db.commit()
+    run_migrations(db, [("1", "2", _migrate_v2)])
+
+
+def _migrate_v2(db: ChapterDb):
+    # Incremented whenever a page's ocr_data changes (OCR results saved, blocks edited or deleted)
+    # so that readers can tell which pages to reload
+    db.execute(
+        """
+        ALTER TABLE pages
+        ADD COLUMN ocr_version INTEGER NOT NULL DEFAULT 0
+        """
+    )
 
 
 def update_chapter(
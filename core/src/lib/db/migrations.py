@@ -0,0 +1,42 @@
+import sqlite3
+from typing import Callable
+
+# Schema migrations for the dbs that keep their version in a metadata table (reader db, chapter dbs)
+
+# (version before, version after, function that makes the changes)
+Migration = tuple[str, str, Callable[[sqlite3.Connection], None]]
+
+
+def run_migrations(db: sqlite3.Connection, migrations: list[Migration]):
+    # Applies each migration in order if the db is at its "before" version
+    r = db.execute("SELECT version FROM metadata").fetchone()
+    if r is None:
+        db.execute("INSERT INTO metadata (version) VALUES (?)", ["1"])
+        db.commit()
+
+    for before, after, fn in migrations:
+        _migrate(db, before, after, fn)
+
+
+def _migrate(db: sqlite3.Connection, before: str, after: str, fn):
+    # Checked without a lock first since this runs on every connection and is almost always up to date
+    # (taking the write lock here would make every reader wait on the other processes' writes)
+    if _get_version(db) != before:
+        return
+
+    # Then again under the lock so that processes opening the db at the same time don't both migrate
+    db.execute("BEGIN IMMEDIATE")
+
+    try:
+        if _get_version(db) == before:
+            fn(db)
+            db.execute("UPDATE metadata SET version = ?", [after])
+
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+
+def _get_version(db: sqlite3.Connection) -> str:
+    return db.execute("SELECT version FROM metadata").fetchone()[0]
@@ -0,0 +1,60 @@
+import json
+import sqlite3
+from typing import TypeAlias
+
+from ..paths import DATA_DIR
+
+OcrCache: TypeAlias = sqlite3.Connection
+
+# OCR results for every page OCR'd so far, shared by all chapters
+# Keyed by the page's pixel hash (see chapter_db.insert_page) and the models / settings that produced them,
+# so that the same image in another chapter (or re-imported) doesn't need to be OCR'd again
+
+
+def load_ocr_cache() -> OcrCache:
+    db = sqlite3.connect(DATA_DIR / "ocr_cache.sqlite")
+    db.row_factory = sqlite3.Row
+
+    # Read by the web server while the OCR workers write to it
+    db.execute("PRAGMA busy_timeout = 10000")
+    db.execute("PRAGMA journal_mode = WAL")
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pages (
+            sha256      TEXT     NOT NULL,
+            model       TEXT     NOT NULL,
+            blocks      TEXT     NOT NULL,
+
+            PRIMARY KEY (sha256, model)
+        )
+        """
+    )
+
+    return db
+
+
+def select_cached_ocr(cache: OcrCache, sha256: str, model: str) -> list[dict] | None:
+    r = cache.execute(
+        """
+        SELECT blocks
+        FROM pages
+        WHERE sha256 = ? AND model = ?
+        """,
+        [sha256, model],
+    ).fetchone()
+
+    return json.loads(r["blocks"]) if r else None
+
+
+def insert_cached_ocr(cache: OcrCache, sha256: str, model: str, blocks: list[dict]):
+    cache.execute(
+        """
+        INSERT OR REPLACE INTO pages (
+            sha256, model, blocks
+        ) VALUES (
+            ?, ?, ?
+        )
+        """,
+        [sha256, model, json.dumps(blocks)],
+    )
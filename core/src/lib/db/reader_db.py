@@ -2,6 +2,7 @@ import sqlite3
 from typing import TypeAlias
 
 from ..paths import DATA_DIR
+from .migrations import run_migrations
 
 ReaderDb: TypeAlias = sqlite3.Connection
 
@@ -10,6 +11,12 @@ def load_reader_db() -> ReaderDb:
     db = sqlite3.connect(DATA_DIR / "reader.sqlite")
     db.row_factory = sqlite3.Row
 
+    # The web server and every job worker write to this db concurrently
+    # so let readers and writers run in parallel (WAL) and wait on locks instead of erroring
+    db.execute("PRAGMA busy_timeout = 10000")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS metadata (
@@ -43,13 +50,85 @@ def load_reader_db() -> ReaderDb:
     return db
 
 
-def clear_jobs(db: ReaderDb):
-    db.execute("DELETE FROM jobs")
-    db.commit()
+def _check_version(db: ReaderDb):
+    run_migrations(
+        db,
+        [
+            ("1", "2", _migrate_v2),
+            ("2", "3", _migrate_v3),
+            ("3", "4", _migrate_v4),
+            ("4", "5", _migrate_v5),
+        ],
+    )
 
+    # Let the job purge task return freed pages to the OS (PRAGMA incremental_vacuum)
+    # Switching an existing db over requires a full vacuum, but only once
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
 
-def _check_version(db: ReaderDb):
-    r = db.execute("SELECT version FROM metadata").fetchone()
-    if r is None:
-        db.execute("INSERT INTO metadata (version) VALUES (?)", ["1"])
-        db.commit()
+
+def _migrate_v2(db: ReaderDb):
+    # Higher priority jobs are processed first
+    db.execute(
+        """
+        ALTER TABLE jobs
+        ADD COLUMN priority INTEGER NOT NULL DEFAULT 0
+        """
+    )
+
+
+def _migrate_v3(db: ReaderDb):
+    # Worker that claimed the job and when it last confirmed it's still alive
+    db.execute("ALTER TABLE jobs ADD COLUMN lease_owner TEXT")
+    db.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at TEXT")
+
+    # Retries
+    db.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    db.execute("ALTER TABLE jobs ADD COLUMN max_attempts INTEGER NOT NULL DEFAULT 3")
+    db.execute("ALTER TABLE jobs ADD COLUMN available_at TEXT")
+
+
+def _migrate_v4(db: ReaderDb):
+    # Pending jobs, in the order they're claimed
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS jobs_queue
+        ON jobs (type, processing, priority DESC)
+        """
+    )
+
+    # Unfinished jobs (queue position) and finished jobs (purging)
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS jobs_done
+        ON jobs (type, done_at, priority)
+        """
+    )
+
+    # In-flight jobs (heartbeats, expired leases)
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS jobs_active
+        ON jobs (type, priority)
+        WHERE processing = 1 AND done_at IS NULL
+        """
+    )
+
+
+def _migrate_v5(db: ReaderDb):
+    # Recent proxy requests for the per-origin rate limits (see proxy/request_log.py)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS proxy_requests (
+            origin          TEXT  NOT NULL,
+            requested_at    REAL  NOT NULL
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS proxy_requests_origin
+        ON proxy_requests (origin, requested_at)
+        """
+    )
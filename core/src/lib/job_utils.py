@@ -1,49 +1,297 @@
 import asyncio
 import datetime
 import json
+import os
+import socket
+import threading
 import time
+import traceback
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
 from typing import Any, Callable
 
 from .config import Config
 from .db.reader_db import ReaderDb, load_reader_db
+from .metrics import Counter, Gauge, Histogram, register_collector
+from .model_residency import (
+    drop_model,
+    register_model_worker,
+    reserve_model_memory,
+    set_model_busy,
+)
+from .worker_events import (
+    emit_worker_event,
+    get_worker_event_queue,
+    init_worker_process,
+    is_worker_process,
+    on_worker_event,
+)
 
 
 class _NULL:
     pass
 
 
+# Job priorities, higher numbers are processed first
+# (jobs with the same priority are processed in insertion order)
+PRIORITY_BULK = 0
+PRIORITY_PREFETCH = 10
+PRIORITY_INTERACTIVE = 20
+
+# Claimed jobs whose worker hasn't sent a heartbeat in this long are assumed to be dead
+LEASE_SECONDS = 60
+
+# Failed jobs are retried after RETRY_DELAY_SECONDS, then twice that, etc
+RETRY_DELAY_SECONDS = 5
+
+# Idle workers are checked this often and restarted if they don't respond
+PING_INTERVAL_SECONDS = 60
+PING_TIMEOUT_SECONDS = 10
+
+
+@dataclass
+class JobRetention:
+    # Finished jobs are deleted once they're older than this...
+    max_age_seconds: float = 600
+
+    # ...or once there are more than this many newer finished jobs of the same type...
+    max_rows: int | None = None
+
+    # ...or once the newer finished jobs of the same type have results totaling this many bytes
+    max_result_bytes: int | None = None
+
+
+# Retention policies for the job types whose workers were started in this process
+_RETENTION_POLICIES: dict[str, JobRetention] = dict()
+
+# Latest progress of the jobs being run by this process's workers, keyed by (job type, job id)
+# Workers report progress through here instead of the db, which only gets the final state
+_LIVE_PROGRESS: dict[tuple[str, str], dict] = dict()
+_IN_FLIGHT_JOBS: set[tuple[str, str]] = set()
+
+# Overrides the polling delays, see set_job_poll_interval()
+_POLL_SECONDS: float | None = None
+
+# (Worker side) last progress reported for each job, saved to the db once the job is done
+_REPORTED_PROGRESS: dict[tuple[str, str], dict] = dict()
+
+_QUEUE_DEPTH = Gauge("reader_job_queue_depth", "Jobs waiting to be claimed")
+_OLDEST_PENDING = Gauge(
+    "reader_job_oldest_pending_seconds",
+    "Age of the oldest job waiting to be claimed",
+)
+_IN_FLIGHT = Gauge("reader_job_in_flight", "Jobs claimed but not finished")
+
+# Kept open for _collect_queue_metrics(), which runs on every scrape
+# One per thread, since it's called from the threadpool
+_METRICS_DB = threading.local()
+_WAIT_TIME = Histogram(
+    "reader_job_wait_seconds",
+    "Time between a job being inserted and first claimed",
+)
+_PROCESSING_TIME = Histogram(
+    "reader_job_processing_seconds",
+    "Time spent processing a job (per attempt)",
+)
+_COMPLETED = Counter("reader_job_completed_total", "Jobs finished successfully")
+_FAILURES = Counter(
+    "reader_job_failures_total",
+    "Failed job attempts (including ones that will be retried)",
+)
+_RETRIES = Counter("reader_job_retries_total", "Job attempts after the first")
+_WORKER_BUSY = Gauge("reader_worker_busy", "1 if the worker is processing a job")
+_WORKER_RESTARTS = Counter(
+    "reader_worker_restarts_total",
+    "Worker processes replaced after crashing, hanging or timing out",
+)
+_WORKER_ERRORS = Counter(
+    "reader_worker_errors_total",
+    "Unexpected errors in the worker loops (eg the db staying locked), retried after a backoff",
+)
+
+
+# Wake-up signals for the worker loops running in this process, by job type
+_WORKER_EVENTS: dict[str, tuple[asyncio.AbstractEventLoop, asyncio.Event]] = dict()
+
+
+def notify_job_worker(job_type: str):
+    # Wake up the worker loop for this job type (if it's running in this process)
+    # Safe to call from any thread
+    #
+    # Jobs queued by another job (eg OCR for the pages of an imported chapter)
+    # are passed on to the process that started the worker, which may be running the loop
+    # (a forked worker process only has a copy of the parent's loops)
+    if is_worker_process():
+        emit_worker_event("wake_job_worker", target_type=job_type)
+        return
+
+    target = _WORKER_EVENTS.get(job_type)
+    if not target:
+        return
+
+    loop, event = target
+
+    try:
+        loop.call_soon_threadsafe(event.set)
+    except RuntimeError:
+        # Loop is closed
+        pass
+
+
+# Pending wait_job() calls in this process, by (job type, job id)
+_JOB_WAITERS: dict[
+    tuple[str, str],
+    list[tuple[asyncio.AbstractEventLoop, asyncio.Future]],
+] = dict()
+
+
+def notify_job_done(job_type: str, id: str):
+    # Wake up any wait_job() calls for this job
+    # Safe to call from any thread
+    for loop, fut in _JOB_WAITERS.pop((job_type, id), []):
+        try:
+            loop.call_soon_threadsafe(_resolve_waiter, fut)
+        except RuntimeError:
+            # Loop is closed
+            pass
+
+
+def _resolve_waiter(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
 @dataclass
 class JobManager:
     db: ReaderDb
     job_type: str
 
-    def select_all_pending(self) -> list[str]:
+    def claim(
+        self,
+        owner: str,
+        limit: int | None = None,
+        min_priority: int | None = None,
+    ) -> list[dict]:
+        # Mark the next pending jobs as processing and return their ids (and some metadata)
+        # This happens in a single statement so concurrent workers never claim the same job
+        now = _now()
+
         rs = self.db.execute(
             """
-            SELECT id 
+            UPDATE jobs
+            SET
+                processing = 1,
+                lease_owner = ?,
+                heartbeat_at = ?,
+                attempts = attempts + 1
+            WHERE rowid IN (
+                SELECT rowid
+                FROM jobs
+                WHERE
+                    type = ?
+                    AND processing = 0
+                    AND (available_at IS NULL OR available_at <= ?)
+                    AND priority >= ?
+                ORDER BY priority DESC, rowid
+                LIMIT ?
+            )
+            RETURNING id, priority, rowid, created_at, attempts
+            """,
+            [
+                owner,
+                now,
+                self.job_type,
+                now,
+                PRIORITY_BULK if min_priority is None else min_priority,
+                limit or -1,
+            ],
+        ).fetchall()
+        self.db.commit()
+
+        rs.sort(key=lambda r: (-r["priority"], r["rowid"]))
+        return [dict(r) for r in rs]
+
+    def select_next_retry(self, min_priority: int | None = None) -> float | None:
+        # Seconds until the first job that's waiting out its retry delay (see fail()) can be claimed
+        r = self.db.execute(
+            """
+            SELECT MIN(available_at) AS available_at
             FROM jobs
             WHERE
                 type = ?
                 AND processing = 0
-            ORDER BY rowid
+                AND available_at > ?
+                AND priority >= ?
             """,
-            [self.job_type],
-        ).fetchall()
+            [
+                self.job_type,
+                _now(),
+                PRIORITY_BULK if min_priority is None else min_priority,
+            ],
+        ).fetchone()
+
+        if not r or not r["available_at"]:
+            return None
 
-        return [r["id"] for r in rs]
+        available_at = datetime.datetime.fromisoformat(r["available_at"])
+        return (available_at - datetime.datetime.now()).total_seconds()
 
-    def lock_all(self, ids: list[str]):
-        self.db.executemany(
+    def heartbeat(self, owner: str):
+        # Extend the lease on every job claimed by this owner
+        self.db.execute(
             """
-            UPDATE jobs 
-            SET processing = 1
-            WHERE 
+            UPDATE jobs INDEXED BY jobs_active
+            SET heartbeat_at = ?
+            WHERE
+                type = ?
+                AND lease_owner = ?
+                AND processing = 1
+                AND done_at IS NULL
+            """,
+            [_now(), self.job_type, owner],
+        )
+        self.db.commit()
+
+    def fail(self, id: str, error: dict):
+        # Put the job back in the queue with an exponential backoff
+        # or mark it as failed if it's out of attempts
+        r = self.db.execute(
+            """
+            SELECT attempts, max_attempts
+            FROM jobs
+            WHERE
                 id = ?
                 AND type = ?
             """,
-            [(id, self.job_type) for id in ids],
+            [id, self.job_type],
+        ).fetchone()
+
+        if not r:
+            return
+
+        if r["attempts"] >= r["max_attempts"]:
+            self.set_error(id, error)
+            return
+
+        # The retry starts from scratch
+        _REPORTED_PROGRESS.pop((self.job_type, id), None)
+
+        delay = RETRY_DELAY_SECONDS * 2 ** (r["attempts"] - 1)
+        available_at = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+
+        self.db.execute(
+            """
+            UPDATE jobs
+            SET
+                processing = 0,
+                lease_owner = NULL,
+                available_at = ?
+            WHERE
+                id = ?
+                AND type = ?
+            """,
+            [available_at.isoformat(), id, self.job_type],
         )
 
     def select(self, id: str, default: Any = _NULL) -> Any:
@@ -79,9 +327,25 @@ class JobManager:
         progress = json.loads(r["progress"])
         done_at = bool(r["done_at"])
 
+        if not done_at:
+            progress = _LIVE_PROGRESS.get((self.job_type, id), progress)
+
         return progress, done_at
 
+    def report_progress(self, id: str, progress: dict):
+        # Cheap progress update for in-flight jobs, nothing is written to the db
+        # The last reported state is saved when the job is marked as done / failed
+        _REPORTED_PROGRESS[(self.job_type, id)] = progress
+        emit_worker_event(
+            "job_progress",
+            job_type=self.job_type,
+            job_id=id,
+            progress=progress,
+        )
+
     def update_progress(self, id: str, progress: dict):
+        _REPORTED_PROGRESS.pop((self.job_type, id), None)
+
         self.db.execute(
             """
                 UPDATE jobs 
@@ -93,37 +357,93 @@ class JobManager:
             [json.dumps(progress), id, self.job_type],
         )
 
-    def delete(self, id: str):
+    def insert(
+        self,
+        id: str,
+        data: dict,
+        priority: int = PRIORITY_INTERACTIVE,
+        requeue_done=False,
+        max_attempts=3,
+    ):
+        # Add a job to the queue and wake up the matching worker
+        # If the job is already queued, its priority is raised to match (but never lowered)
+        # If the job is already done, the old result is kept unless requeue_done is set
+        # This commits immediately so that the worker can see the new row as soon as it wakes up
         self.db.execute(
             """
-            DELETE FROM jobs
-            WHERE
-                id = ?
-                AND type = ?
+            INSERT INTO jobs (
+                id, created_at, type, data, processing, progress, priority, max_attempts
+            ) VALUES (
+                :id, :created_at, :type, :data, 0, '{}', :priority, :max_attempts
+            )
+            ON CONFLICT (id, type) DO UPDATE
+                SET
+                    priority = IIF(
+                        done_at IS NULL,
+                        MAX(priority, excluded.priority),
+                        excluded.priority
+                    ),
+                    created_at = IIF(done_at IS NULL, created_at, excluded.created_at),
+                    data = IIF(done_at IS NULL, data, excluded.data),
+                    progress = IIF(done_at IS NULL, progress, excluded.progress),
+                    processing = IIF(done_at IS NULL, processing, 0),
+                    result = IIF(done_at IS NULL, result, NULL),
+                    error = IIF(done_at IS NULL, error, NULL),
+                    attempts = IIF(done_at IS NULL, attempts, 0),
+                    max_attempts = IIF(done_at IS NULL, max_attempts, excluded.max_attempts),
+                    available_at = IIF(done_at IS NULL, available_at, NULL),
+                    done_at = NULL
+                WHERE
+                    done_at IS NULL
+                    OR :requeue_done
             """,
-            [id, self.job_type],
+            dict(
+                id=id,
+                created_at=_now(),
+                type=self.job_type,
+                data=json.dumps(data),
+                priority=priority,
+                requeue_done=requeue_done,
+                max_attempts=max_attempts,
+            ),
         )
+        self.db.commit()
 
-    def insert(self, id: str, data: dict):
-        self.db.execute(
+        notify_job_worker(self.job_type)
+
+    def bump(self, id: str) -> bool:
+        # Move a pending job to the front of the queue
+        # Returns False if the job doesn't exist or was already started
+        cursor = self.db.execute(
             """
-            INSERT OR IGNORE INTO jobs (
-                id, created_at, type, data, processing, progress
-            ) VALUES (
-                ?, ?, ?, ?, ?, ?
+            UPDATE jobs
+            SET priority = MAX(
+                ?,
+                (
+                    SELECT MAX(priority) + 1
+                    FROM jobs
+                    WHERE
+                        type = ?
+                        AND processing = 0
+                )
             )
+            WHERE
+                id = ?
+                AND type = ?
+                AND processing = 0
             """,
-            [
-                id,
-                datetime.datetime.now().isoformat(),
-                self.job_type,
-                json.dumps(data),
-                False,
-                "{}",
-            ],
+            [PRIORITY_INTERACTIVE, self.job_type, id, self.job_type],
         )
+        self.db.commit()
+
+        return cursor.rowcount > 0
 
     def set_result(self, id: str, result: dict):
+        # Mark a job as done
+        # The caller is responsible for committing, after which notify_job_done() should be called
+        # (the worker loop does this automatically for jobs it dispatched)
+        self._save_reported_progress(id)
+
         self.db.execute(
             """
             UPDATE jobs
@@ -136,13 +456,15 @@ class JobManager:
             """,
             [
                 json.dumps(result),
-                datetime.datetime.now().isoformat(),
+                _now(),
                 id,
                 self.job_type,
             ],
         )
 
     def set_error(self, id: str, error: dict):
+        self._save_reported_progress(id)
+
         self.db.execute(
             """
             UPDATE jobs
@@ -155,13 +477,20 @@ class JobManager:
             """,
             [
                 json.dumps(error),
-                datetime.datetime.now().isoformat(),
+                _now(),
                 id,
                 self.job_type,
             ],
         )
 
+    def _save_reported_progress(self, id: str):
+        progress = _REPORTED_PROGRESS.get((self.job_type, id))
+        if progress is not None:
+            self.update_progress(id, progress)
+
     def select_done(self, id: str) -> tuple[dict | None, dict | None]:
+        # Returns (None, None) if the job is still pending
+        # Raises a KeyError if the job doesn't exist (eg it was deleted after failing)
         r = self.db.execute(
             """
             SELECT result, error, done_at
@@ -173,6 +502,9 @@ class JobManager:
             [id, self.job_type],
         ).fetchone()
 
+        if not r:
+            raise KeyError(id)
+
         if not r["done_at"]:
             return None, None
 
@@ -181,9 +513,11 @@ class JobManager:
         return result, error
 
     def select_queue_position(self, id: str) -> int:
-        rowid_r = self.db.execute(
+        # Number of unfinished jobs that will be (or already are being) processed before this one
+        # Each count is a range scan on an index so this stays cheap even with a long queue
+        target = self.db.execute(
             """
-            SELECT rowid
+            SELECT rowid, priority
             FROM jobs
             WHERE
                 id = ?
@@ -192,21 +526,50 @@ class JobManager:
             [id, self.job_type],
         ).fetchone()
 
-        if not rowid_r:
+        if not target:
             return 0
 
-        rowid = rowid_r["rowid"]
-
         r = self.db.execute(
             """
-            SELECT COUNT(*) count
-            FROM jobs
-            WHERE
-                type = ?
-                AND done_at IS NULL
-                AND rowid < ?
+            SELECT
+                (
+                    -- Pending or in-flight, higher priority
+                    SELECT COUNT(*)
+                    FROM jobs
+                    WHERE
+                        type = :type
+                        AND done_at IS NULL
+                        AND priority > :priority
+                )
+                + (
+                    -- Pending or in-flight, same priority but inserted earlier
+                    SELECT COUNT(*)
+                    FROM jobs
+                    WHERE
+                        type = :type
+                        AND done_at IS NULL
+                        AND priority = :priority
+                        AND rowid < :rowid
+                )
+                + (
+                    -- In-flight, lower priority
+                    SELECT COUNT(*)
+                    FROM jobs INDEXED BY jobs_active
+                    WHERE
+                        type = :type
+                        AND processing = 1
+                        AND done_at IS NULL
+                        AND (
+                            priority < :priority
+                            OR (priority = :priority AND rowid > :rowid)
+                        )
+                ) AS count
             """,
-            [self.job_type, rowid],
+            dict(
+                type=self.job_type,
+                priority=target["priority"],
+                rowid=target["rowid"],
+            ),
         ).fetchone()
 
         return r["count"]
@@ -216,90 +579,669 @@ def start_job_worker(
     cfg: Config,
     job_type: str,
     consume_fn: Callable[[Config, list[str]], None],
+    num_workers: int = 1,
     initializer: Callable | None = None,
     initargs=(),
-    delay: float = 1,
-    batch_size: int | None = None,
+    delay: float = 10,
+    batch_size: int = 1,
     idle_fn: Callable[[], None] | None = None,
-    idle_time: float = 300,
-):
-    exec = ProcessPoolExecutor(
-        1,
-        initializer=initializer,
-        initargs=initargs,
-    )
+    idle_time: float | None = 300,
+    retention: JobRetention | None = None,
+    job_timeout: float | None = None,
+    batch_delay: float = 0,
+    max_bulk_workers: int | None = None,
+    load_fn: Callable[[Config], None] | None = None,
+    load_timeout: float | None = None,
+) -> list[asyncio.Task]:
+    _RETENTION_POLICIES[job_type] = retention or JobRetention()
+
+    # New jobs wake the loops up via notify_job_worker()
+    # so the delay is only a fallback for jobs inserted by other processes
+    delay = _poll_delay(delay)
+    loop = asyncio.get_running_loop()
+    wake_event = asyncio.Event()
+    _WORKER_EVENTS[job_type] = (loop, wake_event)
+
+    # idle_fn unloads the worker's model, either after idle_time seconds without jobs
+    # or when the model residency manager needs the memory for another model (see model_residency.py)
+    unload_when_idle = idle_fn is not None and idle_time is not None
+
+    # Each worker gets its own process (and its own copy of whatever model the job type needs)
+    # Jobs are claimed atomically so the workers never grab the same job
+    #
+    # Workers only claim a few jobs at a time (batch_size)
+    # so that newly inserted, higher priority jobs don't have to wait for the whole backlog
+    #
+    # Only the first max_bulk_workers workers take PRIORITY_BULK jobs
+    # so that the rest are free for jobs that someone's actually waiting on
+    async def fn(idx: int):
+        def create_executor():
+            return ProcessPoolExecutor(
+                1,
+                initializer=init_worker_process,
+                initargs=(
+                    get_worker_event_queue(),
+                    dict(job_type=job_type, worker=idx),
+                    initializer,
+                    initargs,
+                ),
+            )
+
+        # Replace the worker process if it crashed (eg segfault / OOM) or is stuck
+        def restart(reason: str):
+            nonlocal exec
+            print(f"Restarting {job_type} worker {idx} ({reason})")
+
+            _kill_executor(exec)
+            exec = create_executor()
+
+            _WORKER_RESTARTS.inc(job_type=job_type, worker=idx, reason=reason)
+            drop_model(job_type, idx)
+
+        async def unload_model():
+            assert idle_fn
+            try:
+                await loop.run_in_executor(exec, idle_fn)
+            except BrokenProcessPool:
+                restart("crash")
+
+        exec = create_executor()
+        if idle_fn:
+            register_model_worker(job_type, idx, unload_model)
 
-    async def fn():
         db = load_reader_db()
         jobber = JobManager(db, job_type)
-        loop = asyncio.get_running_loop()
+        owner = f"{socket.gethostname()}:{os.getpid()}:{job_type}:{idx}"
+
+        min_priority = None
+        if max_bulk_workers is not None and idx >= max_bulk_workers:
+            min_priority = PRIORITY_BULK + 1
+
+        _WORKER_BUSY.set(0, job_type=job_type, worker=idx)
 
         last_request = time.time()
+        last_ping = time.time()
         is_idle = True
-        while True:
-            todo = jobber.select_all_pending()
-            if batch_size:
-                todo = todo[:batch_size]
+
+        async def process_next():
+            nonlocal last_request, last_ping, is_idle
+
+            # Clear before checking so that inserts made during the check aren't missed
+            wake_event.clear()
+
+            claimed = jobber.claim(owner, batch_size, min_priority)
+            if claimed and batch_delay:
+                claimed += await _fill_batch(
+                    jobber,
+                    owner,
+                    wake_event,
+                    batch_size - len(claimed),
+                    batch_delay,
+                    claimed,
+                    min_priority,
+                )
+            todo = [job["id"] for job in claimed]
 
             if not todo:
-                if idle_fn and not is_idle and time.time() - last_request >= idle_time:
+                idle_for = time.time() - last_request
+                if unload_when_idle and not is_idle and idle_for >= idle_time:
                     is_idle = True
-                    await loop.run_in_executor(exec, idle_fn)
+                    await unload_model()
 
-                await asyncio.sleep(delay)
-                continue
+                # Check that the worker process still responds
+                if time.time() - last_ping >= PING_INTERVAL_SECONDS:
+                    last_ping = time.time()
+                    if not await _ping(exec):
+                        restart("ping")
 
-            # Update processing status
-            jobber.lock_all(todo)
-            db.commit()
+                timeout = delay
+                if unload_when_idle and not is_idle:
+                    timeout = min(timeout, last_request + idle_time - time.time())
+
+                # Nothing wakes the loop up when a retry becomes due
+                next_retry = jobber.select_next_retry(min_priority)
+                if next_retry is not None:
+                    timeout = min(timeout, next_retry)
+
+                try:
+                    await asyncio.wait_for(wake_event.wait(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+
+                return
 
-            await loop.run_in_executor(exec, consume_fn, cfg, todo)
+            _record_claimed(job_type, claimed)
+            _IN_FLIGHT_JOBS.update((job_type, id) for id in todo)
+
+            _WORKER_BUSY.set(1, job_type=job_type, worker=idx)
+            start = time.time()
+
+            heartbeat_task = asyncio.create_task(_heartbeat(jobber, owner))
+            loading = False
+            try:
+                # Make room for the model if it needs to be (re)loaded
+                if idle_fn:
+                    await reserve_model_memory(job_type, idx)
+                    set_model_busy(job_type, idx, True)
+
+                # Load the model (if it isn't already) separately so that a slow load,
+                # eg downloading the weights the first time, doesn't count towards job_timeout
+                if load_fn:
+                    loading = True
+                    await asyncio.wait_for(
+                        loop.run_in_executor(exec, load_fn, cfg),
+                        load_timeout,
+                    )
+                    loading = False
+
+                await asyncio.wait_for(
+                    loop.run_in_executor(exec, consume_fn, cfg, todo),
+                    job_timeout * len(todo) if job_timeout else None,
+                )
+            except asyncio.TimeoutError:
+                if loading:
+                    reason = f"Loading the model timed out after {load_timeout}s"
+                else:
+                    reason = f"Timed out after {job_timeout}s"
+
+                _release_jobs(jobber, todo, reason)
+                restart("timeout")
+            except BrokenProcessPool:
+                _release_jobs(jobber, todo, "Worker process died")
+                restart("crash")
+            except Exception:
+                traceback.print_exc()
+                _release_jobs(jobber, todo, traceback.format_exc())
+            finally:
+                heartbeat_task.cancel()
+                _WORKER_BUSY.set(0, job_type=job_type, worker=idx)
+                if idle_fn:
+                    set_model_busy(job_type, idx, False)
+
+                for id in todo:
+                    _IN_FLIGHT_JOBS.discard((job_type, id))
+                    _LIVE_PROGRESS.pop((job_type, id), None)
+
+            elapsed = time.time() - start
+            for id in todo:
+                _PROCESSING_TIME.observe(elapsed / len(todo), job_type=job_type)
+
+            _record_outcomes(jobber, todo)
+
+            # Done or deleted, either way the waiters should re-check
+            for id in todo:
+                notify_job_done(job_type, id)
 
             last_request = time.time()
+            last_ping = time.time()
             is_idle = False
 
-    return asyncio.create_task(fn())
+        # Anything that escapes process_next() (eg the db staying locked past busy_timeout) is logged
+        # and retried after a backoff instead of silently killing the worker
+        # Jobs it had already claimed are requeued once their lease runs out
+        errors = 0
+        while True:
+            try:
+                await process_next()
+                errors = 0
+            except Exception:
+                traceback.print_exc()
+                _WORKER_ERRORS.inc(job_type=job_type, worker=idx)
+
+                errors += 1
+                await asyncio.sleep(_get_error_backoff(errors, delay))
+
+    return [asyncio.create_task(fn(idx)) for idx in range(num_workers)]
+
+
+async def _fill_batch(
+    jobber: JobManager,
+    owner: str,
+    wake_event: asyncio.Event,
+    limit: int,
+    max_delay: float,
+    claimed: list[dict],
+    min_priority: int | None = None,
+) -> list[dict]:
+    # Wait up to max_delay seconds for more jobs to fill out the rest of the batch
+    # Not worth holding up interactive jobs for though
+    extra: list[dict] = []
+    deadline = time.time() + max_delay
+
+    while len(extra) < limit:
+        if any(job["priority"] >= PRIORITY_INTERACTIVE for job in claimed + extra):
+            break
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        wake_event.clear()
+        try:
+            await asyncio.wait_for(wake_event.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+        extra += jobber.claim(owner, limit - len(extra), min_priority)
+
+    return extra
+
+
+def _release_jobs(jobber: JobManager, ids: list[str], reason: str):
+    # Retry (or fail) the jobs that a worker didn't get to finish
+    for id in ids:
+        try:
+            result, error = jobber.select_done(id)
+        except KeyError:
+            continue
+
+        if result is None and error is None:
+            jobber.fail(id, dict(error=reason))
+
+    jobber.db.commit()
+
+
+async def _ping(exec: ProcessPoolExecutor) -> bool:
+    loop = asyncio.get_running_loop()
+
+    try:
+        await asyncio.wait_for(
+            loop.run_in_executor(exec, os.getpid),
+            PING_TIMEOUT_SECONDS,
+        )
+        return True
+    except Exception:
+        return False
+
+
+def _kill_executor(exec: ProcessPoolExecutor):
+    # shutdown() alone would wait for the current task, which may never finish
+    for proc in list(getattr(exec, "_processes", {}).values()):
+        proc.kill()
+
+    exec.shutdown(wait=False, cancel_futures=True)
+
+
+def _record_claimed(job_type: str, claimed: list[dict]):
+    now = datetime.datetime.now()
+
+    for job in claimed:
+        if job["attempts"] > 1:
+            _RETRIES.inc(job_type=job_type)
+            continue
+
+        created_at = datetime.datetime.fromisoformat(job["created_at"])
+        _WAIT_TIME.observe((now - created_at).total_seconds(), job_type=job_type)
+
+
+def _record_outcomes(jobber: JobManager, ids: list[str]):
+    for id in ids:
+        try:
+            result, error = jobber.select_done(id)
+        except KeyError:
+            continue
+
+        if result is not None:
+            _COMPLETED.inc(job_type=jobber.job_type)
+        else:
+            # Either out of attempts or put back in the queue for a retry
+            _FAILURES.inc(job_type=jobber.job_type)
+
+
+def _collect_queue_metrics():
+    db: ReaderDb | None = getattr(_METRICS_DB, "db", None)
+    if db is None:
+        db = _METRICS_DB.db = load_reader_db()
+
+    now = datetime.datetime.now()
+
+    rs = db.execute(
+        """
+        SELECT
+            type,
+            SUM(processing = 0) AS pending,
+            SUM(processing = 1) AS in_flight,
+            MIN(IIF(processing = 0, created_at, NULL)) AS oldest
+        FROM jobs
+        WHERE done_at IS NULL
+        GROUP BY type
+        """
+    ).fetchall()
+
+    depth, in_flight, oldest_pending = [], [], []
+    for r in rs:
+        labels = dict(job_type=r["type"])
+        depth.append((r["pending"], labels))
+        in_flight.append((r["in_flight"], labels))
+
+        age = 0
+        if r["oldest"]:
+            oldest = datetime.datetime.fromisoformat(r["oldest"])
+            age = (now - oldest).total_seconds()
+        oldest_pending.append((age, labels))
+
+    # Job types without any unfinished jobs are dropped
+    _QUEUE_DEPTH.replace(depth)
+    _IN_FLIGHT.replace(in_flight)
+    _OLDEST_PENDING.replace(oldest_pending)
+
+
+def _on_job_progress(event: dict):
+    key = (event["job_type"], event["job_id"])
+
+    # Ignore stragglers that arrive after the job finished
+    if key not in _IN_FLIGHT_JOBS:
+        return
+
+    _LIVE_PROGRESS[key] = event["progress"]
+
+
+register_collector(_collect_queue_metrics)
+on_worker_event("job_progress", _on_job_progress)
+on_worker_event(
+    "wake_job_worker",
+    lambda event: notify_job_worker(event["target_type"]),
+)
+
+
+async def _heartbeat(jobber: JobManager, owner: str):
+    # Keeps going after an error, the lease only runs out if several heartbeats in a row fail
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        try:
+            jobber.heartbeat(owner)
+        except Exception:
+            traceback.print_exc()
+
+
+def _get_error_backoff(errors: int, max_delay: float) -> float:
+    return min(RETRY_DELAY_SECONDS * 2 ** (errors - 1), max_delay)
+
+
+def requeue_expired_jobs(db: ReaderDb):
+    # Put jobs whose worker died (eg server crash / restart) back into the queue
+    # or mark them as failed if they're out of attempts
+    # That's jobs whose lease ran out, or that were claimed by a process on this machine that no longer exists
+    # (so that a quick restart doesn't leave them stuck until their lease runs out)
+    cutoff = (
+        datetime.datetime.now() - datetime.timedelta(seconds=LEASE_SECONDS)
+    ).isoformat()
+    dead_owners = json.dumps(_select_dead_owners(db))
+
+    db.execute(
+        """
+        UPDATE jobs
+        SET
+            error = ?,
+            done_at = ?
+        WHERE
+            processing = 1
+            AND done_at IS NULL
+            AND (
+                heartbeat_at IS NULL
+                OR heartbeat_at < ?
+                OR lease_owner IN (SELECT value FROM json_each(?))
+            )
+            AND attempts >= max_attempts
+        """,
+        [json.dumps(dict(error="Lease expired")), _now(), cutoff, dead_owners],
+    )
+
+    cursor = db.execute(
+        """
+        UPDATE jobs
+        SET
+            processing = 0,
+            lease_owner = NULL
+        WHERE
+            processing = 1
+            AND done_at IS NULL
+            AND (
+                heartbeat_at IS NULL
+                OR heartbeat_at < ?
+                OR lease_owner IN (SELECT value FROM json_each(?))
+            )
+        """,
+        [cutoff, dead_owners],
+    )
+    db.commit()
+
+    if cursor.rowcount:
+        print(f"Requeued {cursor.rowcount} jobs with expired leases")
 
+        for job_type in _WORKER_EVENTS:
+            notify_job_worker(job_type)
 
-def start_job_purge_task(
-    age_seconds=600,
-    check_freq_seconds=60,
-):
+
+def _select_dead_owners(db: ReaderDb) -> list[str]:
+    # Lease owners are "host:pid:job_type:worker" (see start_job_worker())
+    rs = db.execute(
+        """
+        SELECT DISTINCT lease_owner
+        FROM jobs
+        WHERE
+            processing = 1
+            AND done_at IS NULL
+            AND lease_owner IS NOT NULL
+        """
+    ).fetchall()
+
+    host = socket.gethostname()
+
+    dead = []
+    for r in rs:
+        parts = r["lease_owner"].split(":")
+        if len(parts) < 2 or parts[0] != host or not parts[1].isdigit():
+            continue
+
+        pid = int(parts[1])
+        if pid != os.getpid() and not _is_pid_alive(pid):
+            dead.append(r["lease_owner"])
+
+    return dead
+
+
+def _is_pid_alive(pid: int) -> bool:
+    # os.kill() terminates the process on Windows, so leave those to the lease expiry
+    if os.name == "nt":
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists but belongs to another user
+        return True
+
+    return True
+
+
+def set_job_poll_interval(seconds: float):
+    # For when jobs are inserted and processed by different processes (see scripts/run_workers.py)
+    # The in-process wake ups don't reach the other side so fall back to polling the db more often
+    global _POLL_SECONDS
+    _POLL_SECONDS = seconds
+
+
+def _poll_delay(delay: float) -> float:
+    if _POLL_SECONDS is None:
+        return delay
+
+    return min(delay, _POLL_SECONDS)
+
+
+def start_progress_flush_task(interval_seconds: float = 1):
+    # Save the progress of in-flight jobs to the db every few seconds,
+    # for when the processes reading it (eg the web server) don't get the worker events
     async def fn():
         db = load_reader_db()
+        flushed: dict[tuple[str, str], dict] = dict()
 
         while True:
-            cutoff = datetime.datetime.now() - datetime.timedelta(minutes=age_seconds)
+            await asyncio.sleep(interval_seconds)
 
-            db.execute(
+            updates = [
+                (json.dumps(progress), id, job_type)
+                for (job_type, id), progress in _LIVE_PROGRESS.items()
+                if flushed.get((job_type, id)) is not progress
+            ]
+            flushed = dict(_LIVE_PROGRESS)
+
+            if not updates:
+                continue
+
+            db.executemany(
                 """
-                DELETE FROM jobs
-                WHERE done_at < ?
+                UPDATE jobs
+                SET progress = ?
+                WHERE
+                    id = ?
+                    AND type = ?
+                    AND done_at IS NULL
                 """,
-                [cutoff],
+                updates,
             )
             db.commit()
 
+    return asyncio.create_task(fn())
+
+
+def start_job_purge_task(check_freq_seconds=60, vacuum_pages=1000):
+    async def fn():
+        db = load_reader_db()
+
+        while True:
+            requeue_expired_jobs(db)
+            purge_jobs(db)
+
+            # Return the space freed by the purge to the OS, a chunk at a time
+            # (executescript() because execute() only frees a single page)
+            db.executescript(f"PRAGMA incremental_vacuum({vacuum_pages});")
+
             await asyncio.sleep(check_freq_seconds)
 
     return asyncio.create_task(fn())
 
 
-def wait_job(
-    jobber: JobManager,
+def purge_jobs(db: ReaderDb):
+    # Only the job types run by this process are purged,
+    # since the other types' policies are only known to whichever process runs them
+    for job_type, policy in _RETENTION_POLICIES.items():
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            seconds=policy.max_age_seconds
+        )
+        db.execute(
+            """
+            DELETE FROM jobs
+            WHERE
+                type = ?
+                AND done_at < ?
+            """,
+            [job_type, cutoff.isoformat()],
+        )
+
+        if policy.max_rows is not None:
+            db.execute(
+                """
+                DELETE FROM jobs
+                WHERE rowid IN (
+                    SELECT rowid
+                    FROM (
+                        SELECT
+                            rowid,
+                            ROW_NUMBER() OVER (ORDER BY done_at DESC) AS idx
+                        FROM jobs
+                        WHERE
+                            type = ?
+                            AND done_at IS NOT NULL
+                    )
+                    WHERE idx > ?
+                )
+                """,
+                [job_type, policy.max_rows],
+            )
+
+        if policy.max_result_bytes is not None:
+            db.execute(
+                """
+                DELETE FROM jobs
+                WHERE rowid IN (
+                    SELECT rowid
+                    FROM (
+                        SELECT
+                            rowid,
+                            SUM(LENGTH(CAST(COALESCE(result, '') AS BLOB)))
+                                OVER (ORDER BY done_at DESC ROWS UNBOUNDED PRECEDING)
+                                AS total_bytes
+                        FROM jobs
+                        WHERE
+                            type = ?
+                            AND done_at IS NOT NULL
+                    )
+                    WHERE total_bytes > ?
+                )
+                """,
+                [job_type, policy.max_result_bytes],
+            )
+
+        db.commit()
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat()
+
+
+async def wait_job(
+    job_type: str,
     id: str,
     timeout: float | None = None,
-    delay=0.25,
+    delay: float = 5,
 ) -> tuple[dict, None] | tuple[None, dict]:
+    # Wait for a job to be completed by set_result() / set_error()
+    # The worker loop wakes this up as soon as the job is processed
+    # so the delay is only a fallback for jobs processed by other processes
+    # Raises a KeyError if the job doesn't exist (eg it was purged)
+    delay = _poll_delay(delay)
+
+    loop = asyncio.get_running_loop()
     start = time.time()
 
-    result, error = None, None
-    while result is None and error is None:
-        result, error = jobber.select_done(id)
+    while True:
+        # Register before checking so that completions during the check aren't missed
+        fut = loop.create_future()
+        _JOB_WAITERS.setdefault((job_type, id), []).append((loop, fut))
+
+        try:
+            # In a thread since it can wait (up to busy_timeout) on a worker's write lock
+            result, error = await asyncio.to_thread(_select_done, job_type, id)
+            if result is not None or error is not None:
+                return result, error  # type: ignore
+
+            wait_for = delay
+            if timeout:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise TimeoutError()
+                wait_for = min(wait_for, remaining)
+
+            try:
+                await asyncio.wait_for(fut, wait_for)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            waiters = _JOB_WAITERS.get((job_type, id), [])
+            if (loop, fut) in waiters:
+                waiters.remove((loop, fut))
+            if not waiters:
+                _JOB_WAITERS.pop((job_type, id), None)
 
-        if timeout and (time.time() - start) > timeout:
-            raise TimeoutError()
-        else:
-            time.sleep(delay)
 
-    return result, error  # type: ignore
+def _select_done(job_type: str, id: str) -> tuple[dict | None, dict | None]:
+    # sqlite connections can't be shared across threads
+    db = load_reader_db()
+    try:
+        return JobManager(db, job_type).select_done(id)
+    finally:
+        db.close()
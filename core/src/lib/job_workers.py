@@ -0,0 +1,26 @@
+from .config import Config
+from .db.reader_db import load_reader_db
+from .job_utils import requeue_expired_jobs, start_job_purge_task
+from .llm.llm_worker import start_llm_job_worker
+from .model_residency import set_model_memory_budget
+from .ocr import start_ocr_job_worker
+from .proxy.proxy import start_proxy_job_worker
+from .url_import import start_import_job_worker
+
+JOB_WORKERS = {
+    "ocr": start_ocr_job_worker,
+    "llm": start_llm_job_worker,
+    "import": start_import_job_worker,
+    "proxy": start_proxy_job_worker,
+}
+
+
+def start_job_workers(cfg: Config, job_types: list[str] | None = None):
+    # Jobs left over from a previous run are picked up again once their leases expire
+    requeue_expired_jobs(load_reader_db())
+    start_job_purge_task()
+
+    set_model_memory_budget(cfg.model_memory_budget_mb, cfg.model_eviction_policy)
+
+    for job_type in job_types or JOB_WORKERS.keys():
+        JOB_WORKERS[job_type](cfg)
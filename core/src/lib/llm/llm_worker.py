@@ -1,5 +1,6 @@
 import gc
 import json
+import os
 import time
 import traceback
 from typing import Literal
@@ -10,7 +11,14 @@ from llama_cpp import Llama
 from ..config import Config
 from ..db.llm_cache import insert_best_defs, insert_translation, load_llm_cache
 from ..db.reader_db import ReaderDb, load_reader_db
-from ..job_utils import JobManager, start_job_worker
+from ..job_utils import (
+    PRIORITY_PREFETCH,
+    JobManager,
+    JobRetention,
+    start_job_worker,
+    wait_job,
+)
+from ..model_residency import emit_model_loaded, emit_model_unloaded, get_rss_bytes
 from . import LLM_LOGGER
 from .best_defs import get_best_defs
 from .mtl import mtl
@@ -26,8 +34,13 @@ def start_llm_job_worker(cfg: Config):
         cfg,
         _JOB_TYPE,
         _process_all_jobs,
+        num_workers=cfg.num_llm_workers,
         idle_fn=_unload_worker,
-        idle_time=30,
+        idle_time=cfg.model_idle_unload_seconds or None,
+        retention=JobRetention(max_age_seconds=3600, max_rows=10_000),
+        job_timeout=cfg.llm_job_timeout_seconds,
+        load_fn=_load_worker_llm,
+        load_timeout=cfg.model_load_timeout_seconds or None,
     )
 
 
@@ -35,12 +48,13 @@ def insert_llm_job(
     db: ReaderDb,
     text: str,
     type: Literal["mtl", "best_defs"],
+    priority=PRIORITY_PREFETCH,
 ):
     text = text.strip()
 
     LLM_LOGGER.debug(f"Inserting {type} job for {text}")
 
-    id = f"{type}_{text}"
+    id = _get_job_id(text, type)
 
     jobber = JobManager(db, _JOB_TYPE)
     jobber.insert(
@@ -49,19 +63,54 @@ def insert_llm_job(
             text=text,
             type=type,
         ),
+        priority=priority,
+        requeue_done=True,
     )
     db.commit()
 
 
+def bump_llm_job(
+    db: ReaderDb,
+    text: str,
+    type: Literal["mtl", "best_defs"],
+):
+    jobber = JobManager(db, _JOB_TYPE)
+    return jobber.bump(_get_job_id(text.strip(), type))
+
+
+async def wait_llm_job(text: str, type: Literal["mtl", "best_defs"]):
+    return await wait_job(_JOB_TYPE, _get_job_id(text.strip(), type))
+
+
+def _get_job_id(text: str, type: str):
+    return f"{type}_{text}"
+
+
+def _load_worker_llm(cfg: Config):
+    # Normally already loaded by the worker loop (see load_fn in start_job_worker())
+    global _WORKER_LLM
+    if _WORKER_LLM is None:
+        load_start = time.time()
+        rss_before = get_rss_bytes()
+        _WORKER_LLM = _init_worker(cfg)
+
+        # The weights are mmap'd so they don't all show up in the rss right away
+        emit_model_loaded(
+            cfg.llm_model_file,
+            load_start,
+            rss_before,
+            min_footprint=os.path.getsize(_WORKER_LLM.model_path),
+        )
+
+
 def _process_all_jobs(cfg: Config, job_ids: list[str]):
     reader_db = load_reader_db()
     jobber = JobManager(reader_db, _JOB_TYPE)
 
     start = time.time()
 
-    global _WORKER_LLM
-    if _WORKER_LLM is None:
-        _WORKER_LLM = _init_worker(cfg)
+    _load_worker_llm(cfg)
+    assert _WORKER_LLM
 
     for id in job_ids:
         job = None
@@ -75,11 +124,14 @@ def _process_all_jobs(cfg: Config, job_ids: list[str]):
                 _WORKER_LLM,
                 job,
             )
+
+            jobber.set_result(id, dict())
+            reader_db.commit()
         except:
             LLM_LOGGER.exception(f"Failed job {id} {job}")
 
-            # Delete job on error
-            jobber.delete(id)
+            # Retry job on error
+            jobber.fail(id, dict(error=traceback.format_exc()))
             reader_db.commit()
 
     elapsed = (time.time() - start) * 1000
@@ -106,11 +158,19 @@ def _process_job(
 
 def _init_worker(cfg: Config):
     LLM_LOGGER.info("Initializing worker")
+
+    # Split the cores between the workers instead of having each one try to use all of them
+    # (by default llama.cpp uses half the cores)
+    n_threads = None
+    if cfg.num_llm_workers > 1:
+        n_threads = max(1, (os.cpu_count() or 2) // 2 // cfg.num_llm_workers)
+
     return Llama.from_pretrained(
         cfg.llm_model_id,
         cfg.llm_model_file,
         n_ctx=2048,
         n_gpu_layers=cfg.llm_num_gpu_layers,
+        n_threads=n_threads,
     )
 
 
@@ -122,6 +182,7 @@ def _unload_worker():
     LLM_LOGGER.info("Unloading worker")
 
     _WORKER_LLM = None
+    emit_model_unloaded()
 
     gc.collect()
 
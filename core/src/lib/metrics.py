@@ -0,0 +1,163 @@
+import math
+import traceback
+from typing import Callable
+
+# Minimal in-process metrics registry
+# Dumped by the /metrics endpoint as either JSON or the Prometheus text format
+# Not thread-safe, the metrics are only updated and dumped on the event loop thread
+
+LabelKey = tuple[tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    30,
+    60,
+    300,
+    math.inf,
+)
+
+_METRICS: dict[str, "Counter | Gauge | Histogram"] = dict()
+
+# Run by collect_metrics() right before the metrics are dumped, for values that are cheaper to compute on demand
+# They may run on any thread, so they should only update their metrics with Gauge.replace()
+_COLLECTORS: list[Callable[[], None]] = []
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[LabelKey, float] = dict()
+
+        _METRICS[name] = self
+
+    def inc(self, amount: float = 1, **labels):
+        key = _to_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[LabelKey, float] = dict()
+
+        _METRICS[name] = self
+
+    def set(self, value: float, **labels):
+        self.values[_to_key(labels)] = value
+
+    def replace(self, values: list[tuple[float, dict]]):
+        # Swaps in a whole new set of (value, labels) at once,
+        # so that a dump never sees the gauge half cleared
+        self.values = {_to_key(labels): value for value, labels in values}
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+
+        # label key -> (per-bucket counts, sum, count)
+        self.values: dict[LabelKey, tuple[list[int], float, int]] = dict()
+
+        _METRICS[name] = self
+
+    def observe(self, value: float, **labels):
+        key = _to_key(labels)
+        counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+
+        for idx, upper in enumerate(self.buckets):
+            if value <= upper:
+                counts[idx] += 1
+
+        self.values[key] = (counts, total + value, count + 1)
+
+
+def register_collector(fn: Callable[[], None]):
+    _COLLECTORS.append(fn)
+
+
+def dump_metrics() -> dict:
+    data = dict()
+    for m in _METRICS.values():
+        if isinstance(m, Histogram):
+            values = [
+                dict(
+                    labels=dict(key),
+                    count=count,
+                    sum=total,
+                    buckets={
+                        _format_bound(upper): c for upper, c in zip(m.buckets, counts)
+                    },
+                )
+                for key, (counts, total, count) in m.values.items()
+            ]
+        else:
+            values = [dict(labels=dict(key), value=v) for key, v in m.values.items()]
+
+        data[m.name] = dict(type=m.kind, help=m.help, values=values)
+
+    return data
+
+
+def dump_metrics_prometheus() -> str:
+    lines = []
+    for m in _METRICS.values():
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+
+        if isinstance(m, Histogram):
+            for key, (counts, total, count) in m.values.items():
+                for upper, c in zip(m.buckets, counts):
+                    bucket_key = key + (("le", _format_bound(upper)),)
+                    lines.append(f"{m.name}_bucket{_format_labels(bucket_key)} {c}")
+
+                lines.append(f"{m.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{m.name}_count{_format_labels(key)} {count}")
+        else:
+            for key, v in m.values.items():
+                lines.append(f"{m.name}{_format_labels(key)} {v}")
+
+    return "\n".join(lines) + "\n"
+
+
+def collect_metrics():
+    for fn in _COLLECTORS:
+        try:
+            fn()
+        except:
+            traceback.print_exc()
+
+
+def _to_key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+
+    parts = []
+    for k, v in key:
+        v = v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_bound(upper: float) -> str:
+    return "+Inf" if upper == math.inf else str(upper)
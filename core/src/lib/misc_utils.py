@@ -71,6 +71,25 @@ def dump_sse_event(data: dict) -> str:
     return "data: " + json.dumps(data) + "\n\n"
 
 
+def diff_dict(prev: dict, curr: dict) -> dict:
+    # Changes needed to turn prev into curr, for sending smaller SSE updates
+    # Lists that only grew are sent as just the new items
+    changed = dict()
+    appended = dict()
+
+    for k, v in curr.items():
+        if k in prev and prev[k] == v:
+            continue
+
+        old = prev.get(k)
+        if isinstance(old, list) and isinstance(v, list) and v[: len(old)] == old:
+            appended[k] = v[len(old) :]
+        else:
+            changed[k] = v
+
+    return dict(set=changed, append=appended)
+
+
 def to_jamo(text: str) -> list[str]:
     try:
         return [char for char in j2hcj(h2j(text))]
@@ -0,0 +1,274 @@
+import asyncio
+import os
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Literal
+
+from .metrics import Counter, Gauge, Histogram
+from .worker_events import emit_worker_event, on_worker_event
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Keeps track of which job workers (OCR, LLM) have their model loaded
+# and unloads the least valuable ones when the total would go over the memory budget
+#
+# Models live in the worker processes, so the workers report loads / unloads as worker events
+# and the manager asks a worker loop to unload its model through the callback it registered
+#
+# The budget only covers the workers started by this process,
+# so with the workers split across processes (see run_workers.py) each process gets a budget of its own
+
+EvictionPolicy = Literal["lru", "cost"]
+
+WorkerKey = tuple[str, int]
+
+
+@dataclass
+class ResidentModel:
+    job_type: str
+    worker: int
+    model: str
+    footprint_bytes: int
+    load_seconds: float
+
+
+_RESIDENT: dict[WorkerKey, ResidentModel] = dict()
+_UNLOADERS: dict[WorkerKey, Callable[[], Awaitable]] = dict()
+
+# Tracked separately from the models since the load events arrive asynchronously
+_BUSY_WORKERS: set[WorkerKey] = set()
+_LAST_USED: dict[WorkerKey, float] = dict()
+
+# Footprint of the last load for each job type, used as the estimate for the next one
+_LAST_FOOTPRINTS: dict[str, int] = dict()
+
+_BUDGET_BYTES: int | None = None
+_POLICY: EvictionPolicy = "cost"
+
+_MODEL_LOADS = Counter("reader_model_loads_total", "Models loaded by workers")
+_MODEL_LOAD_TIME = Histogram(
+    "reader_model_load_seconds",
+    "Time spent loading models",
+)
+_MODEL_UNLOADS = Counter("reader_model_unloads_total", "Models unloaded by workers")
+_MODEL_EVICTIONS = Counter(
+    "reader_model_evictions_total",
+    "Models unloaded to stay under the memory budget",
+)
+_MODEL_RESIDENT = Gauge(
+    "reader_model_resident",
+    "1 if the worker currently has its model loaded",
+)
+_MODEL_RESIDENT_BYTES = Gauge(
+    "reader_model_resident_bytes",
+    "Memory used by the worker's loaded model",
+)
+_MODEL_BUDGET_BYTES = Gauge(
+    "reader_model_memory_budget_bytes",
+    "Memory budget shared by the models loaded by this process's workers",
+)
+
+
+def set_model_memory_budget(budget_mb: int, policy: EvictionPolicy = "cost"):
+    # 0 means half of the system's memory
+    global _BUDGET_BYTES, _POLICY
+
+    if budget_mb > 0:
+        _BUDGET_BYTES = budget_mb * 1024 * 1024
+    else:
+        _BUDGET_BYTES = _get_total_memory() // 2
+
+    _POLICY = policy
+    _MODEL_BUDGET_BYTES.set(_BUDGET_BYTES)
+
+
+def register_model_worker(
+    job_type: str,
+    worker: int,
+    unload_fn: Callable[[], Awaitable],
+):
+    _UNLOADERS[(job_type, worker)] = unload_fn
+    _MODEL_RESIDENT.set(0, job_type=job_type, worker=worker)
+
+
+def is_model_resident(job_type: str, worker: int) -> bool:
+    return (job_type, worker) in _RESIDENT
+
+
+def set_model_busy(job_type: str, worker: int, busy: bool):
+    key = (job_type, worker)
+
+    if busy:
+        _BUSY_WORKERS.add(key)
+    else:
+        _BUSY_WORKERS.discard(key)
+
+    _LAST_USED[key] = time.time()
+
+
+def drop_model(job_type: str, worker: int):
+    # For when the worker process was killed (along with its model)
+    _RESIDENT.pop((job_type, worker), None)
+    _MODEL_RESIDENT.set(0, job_type=job_type, worker=worker)
+    _MODEL_RESIDENT_BYTES.set(0, job_type=job_type, worker=worker)
+
+
+async def reserve_model_memory(job_type: str, worker: int):
+    # Called before a worker (re)loads its model
+    # Makes room for it using the footprint of the last time this type of model was loaded
+    if is_model_resident(job_type, worker):
+        return
+
+    needed = _LAST_FOOTPRINTS.get(job_type, 0)
+    await _enforce_budget(needed, exclude=(job_type, worker))
+
+
+def get_residency_state() -> dict:
+    return dict(
+        budget_bytes=_BUDGET_BYTES,
+        resident_bytes=sum(m.footprint_bytes for m in _RESIDENT.values()),
+        policy=_POLICY,
+        models=[
+            dict(
+                job_type=m.job_type,
+                worker=m.worker,
+                model=m.model,
+                footprint_bytes=m.footprint_bytes,
+                load_seconds=m.load_seconds,
+                idle_seconds=_idle_seconds(key),
+                busy=key in _BUSY_WORKERS,
+            )
+            for key, m in _RESIDENT.items()
+        ],
+    )
+
+
+def emit_model_loaded(model: str, load_start: float, rss_before: int, min_footprint=0):
+    # Called in the worker process right after loading a model
+    emit_worker_event(
+        "model_loaded",
+        model=model,
+        seconds=time.time() - load_start,
+        footprint_bytes=max(get_rss_bytes() - rss_before, min_footprint),
+    )
+
+
+def emit_model_unloaded():
+    emit_worker_event("model_unloaded")
+
+
+def get_rss_bytes() -> int:
+    # 0 if it can't be measured (Windows), in which case models count as min_footprint
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+
+    if resource is None:
+        return 0
+
+    # No /proc (eg macOS, where ru_maxrss is in bytes)
+    # Peak instead of current usage, but good enough for a before / after diff
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def _enforce_budget(extra_bytes: int = 0, exclude: WorkerKey | None = None):
+    if _BUDGET_BYTES is None:
+        return
+
+    used = sum(m.footprint_bytes for m in _RESIDENT.values())
+    candidates = [
+        m
+        for key, m in _RESIDENT.items()
+        if key != exclude and key not in _BUSY_WORKERS and key in _UNLOADERS
+    ]
+    candidates.sort(key=_eviction_score)
+
+    while used + extra_bytes > _BUDGET_BYTES and candidates:
+        victim = candidates.pop(0)
+        key = (victim.job_type, victim.worker)
+
+        print(
+            f"Unloading {victim.job_type} worker {victim.worker}'s model to stay under the memory budget"
+        )
+        _MODEL_EVICTIONS.inc(job_type=victim.job_type)
+
+        # Subtract now rather than waiting for the unload event, which arrives later
+        used -= victim.footprint_bytes
+        try:
+            await _UNLOADERS[key]()
+        except:
+            traceback.print_exc()
+
+
+def _eviction_score(m: ResidentModel) -> float:
+    # Lowest score is unloaded first
+    idle_seconds = _idle_seconds((m.job_type, m.worker))
+
+    if _POLICY == "lru":
+        return -idle_seconds
+
+    # Prefer unloading models that are cheap to reload for the memory they free, and haven't been used in a while
+    footprint_gb = max(m.footprint_bytes, 1) / 1024**3
+    return m.load_seconds / footprint_gb / (1 + idle_seconds)
+
+
+def _idle_seconds(key: WorkerKey) -> float:
+    if key in _BUSY_WORKERS:
+        return 0
+
+    return max(time.time() - _LAST_USED.get(key, time.time()), 0)
+
+
+def _get_total_memory() -> int:
+    # (no os.sysconf on Windows)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (OSError, ValueError, AttributeError):
+        return 8 * 1024**3
+
+
+def _on_model_loaded(event: dict):
+    job_type = event.get("job_type", "")
+    worker = event.get("worker", 0)
+    labels = dict(job_type=job_type, worker=worker)
+    footprint = event.get("footprint_bytes", 0)
+
+    _MODEL_LOADS.inc(**labels)
+    _MODEL_LOAD_TIME.observe(event["seconds"], job_type=job_type)
+    _MODEL_RESIDENT.set(1, **labels)
+    _MODEL_RESIDENT_BYTES.set(footprint, **labels)
+
+    _LAST_FOOTPRINTS[job_type] = footprint
+    _RESIDENT[(job_type, worker)] = ResidentModel(
+        job_type=job_type,
+        worker=worker,
+        model=event["model"],
+        footprint_bytes=footprint,
+        load_seconds=event["seconds"],
+    )
+
+    # In case the estimate was off (or this was the first load)
+    if _UNLOADERS:
+        asyncio.get_running_loop().create_task(
+            _enforce_budget(exclude=(job_type, worker))
+        )
+
+
+def _on_model_unloaded(event: dict):
+    job_type = event.get("job_type", "")
+    worker = event.get("worker", 0)
+
+    _MODEL_UNLOADS.inc(job_type=job_type, worker=worker)
+    drop_model(job_type, worker)
+
+
+on_worker_event("model_loaded", _on_model_loaded)
+on_worker_event("model_unloaded", _on_model_unloaded)
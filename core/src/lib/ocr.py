@@ -1,22 +1,55 @@
 import gc
+import hashlib
+import json
+import os
+import time
 import traceback
+from dataclasses import dataclass, field
+from functools import lru_cache
 from itertools import chain
 from pathlib import Path
-from typing import Generator
+from typing import Any, Generator
 
 import doctr
 import torch
 from comic_ocr.lib.constants import KOREAN_ALPHABET
-from comic_ocr.lib.inference_utils import calc_windows, eval_window
+from comic_ocr.lib.inference_utils import calc_windows
 from comic_ocr.lib.label_utils import OcrMatch, stitch_blocks, stitch_lines
 from doctr.models.predictor import OCRPredictor
 from PIL import Image
 
 from .config import Config
 from .constants import SUPPORTED_IMAGE_EXTENSIONS
-from .db.chapter_db import insert_ocr_data, load_chapter_db, select_ocr_data
+from .db.chapter_db import (
+    ChapterDb,
+    bump_ocr_version,
+    insert_ocr_block,
+    insert_page,
+    load_chapter_db,
+    select_ocr_data,
+    select_page,
+)
+from .db.ocr_cache import insert_cached_ocr, load_ocr_cache, select_cached_ocr
 from .db.reader_db import ReaderDb, load_reader_db
-from .job_utils import JobManager, start_job_worker
+from .job_utils import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_PREFETCH,
+    JobManager,
+    JobRetention,
+    start_job_worker,
+)
+from .model_residency import emit_model_loaded, emit_model_unloaded, get_rss_bytes
+from .ocr_batch import (
+    WindowCall,
+    bucket_recognition,
+    eval_windows,
+    find_blank_windows,
+    record_window,
+)
+from .ocr_dedupe import dedupe_matches
+from .page_images import open_page, shrink_to_width
+from .sse_hub import notify_sse_hub
 
 _JOB_TYPE = "ocr"
 
@@ -41,12 +74,32 @@ def start_ocr_job_worker(cfg: Config):
         cfg,
         _JOB_TYPE,
         _process_all_jobs,
+        num_workers=cfg.num_ocr_workers,
+        initializer=_init_worker,
+        initargs=(cfg,),
         idle_fn=_unload_worker,
-        idle_time=30,
+        idle_time=cfg.model_idle_unload_seconds or None,
+        retention=JobRetention(max_age_seconds=3600, max_rows=10_000),
+        job_timeout=cfg.ocr_job_timeout_seconds,
+        load_fn=_load_worker_predictor,
+        load_timeout=cfg.model_load_timeout_seconds or None,
+        batch_size=cfg.ocr_max_batch_pages,
+        batch_delay=cfg.ocr_max_batch_delay_seconds,
+        max_bulk_workers=cfg.ocr_prefetch_max_workers or None,
     )
 
 
-def insert_ocr_job(db: ReaderDb, fp_image: Path):
+def insert_ocr_job(
+    cfg: Config,
+    db: ReaderDb,
+    fp_image: Path,
+    priority=PRIORITY_PREFETCH,
+    check_cache=True,
+) -> bool:
+    # Returns False if the page didn't need a job because it was already in the OCR cache
+    if check_cache and _copy_cached_ocr(cfg, fp_image):
+        return False
+
     print("Inserting ocr job for", fp_image)
 
     jobber = JobManager(db, _JOB_TYPE)
@@ -56,130 +109,446 @@ def insert_ocr_job(db: ReaderDb, fp_image: Path):
             fp_image=str(fp_image),
             chap_dir=str(fp_image.parent),
         ),
+        priority=priority,
+        requeue_done=True,
     )
     db.commit()
 
+    return True
+
+
+def prefetch_ocr(cfg: Config, fp_images: list[Path]):
+    # Queue newly added pages (uploads, imports) at the lowest priority
+    # so that they're hopefully done before anyone opens the chapter
+    # The worker checks the OCR cache instead of doing it here since hashing every page would hold up the upload
+    if not cfg.ocr_prefetch:
+        return
+
+    db = load_reader_db()
+    for fp in sorted(fp_images):
+        if fp.suffix.lower() in SUPPORTED_IMAGE_EXTENSIONS:
+            insert_ocr_job(cfg, db, fp, priority=PRIORITY_BULK, check_cache=False)
+
+
+def bump_ocr_job(cfg: Config, db: ReaderDb, fp_image: Path):
+    # Queue it if it isn't already
+    if not insert_ocr_job(cfg, db, fp_image, priority=PRIORITY_INTERACTIVE):
+        return False
+
+    jobber = JobManager(db, _JOB_TYPE)
+    return jobber.bump(str(fp_image))
+
+
+def _load_worker_predictor(cfg: Config):
+    # Normally already loaded by the worker loop (see load_fn in start_job_worker())
+    global _WORKER_PREDICTOR
+    if _WORKER_PREDICTOR is None:
+        load_start = time.time()
+        rss_before = get_rss_bytes()
+        _WORKER_PREDICTOR = load_ocr_predictor(cfg)
+        emit_model_loaded(f"{cfg.det_arch}+{cfg.reco_arch}", load_start, rss_before)
+
 
 def _process_all_jobs(cfg: Config, job_ids: list[str]):
     reader_db = load_reader_db()
     jobber = JobManager(reader_db, _JOB_TYPE)
 
-    global _WORKER_PREDICTOR
-    if _WORKER_PREDICTOR is None:
-        _WORKER_PREDICTOR = _load_predictor(cfg)
+    _load_worker_predictor(cfg)
 
+    # Read all the pages first so that their windows can share batches
+    pages: list[_Page] = []
     for id in job_ids:
         try:
-            _process_job(
-                cfg,
-                _WORKER_PREDICTOR,
-                jobber,
-                id,
-            )
+            job = jobber.select(id)
+            print("Processing ocr job", id, job)
+
+            # Decoded once for both the hash (if needed) and the OCR
+            fp_image = Path(job["fp_image"])
+            im = open_page(fp_image)
+
+            # A copy of the page may have been OCR'd since this job was queued
+            if _copy_cached_ocr(cfg, fp_image, im):
+                jobber.set_result(id, dict())
+                reader_db.commit()
+                continue
+
+            pages.append(_load_page(cfg, id, job, im))
         except:
-            # Delete job on error
+            # Retry job on error
             traceback.print_exc()
 
-            jobber.delete(id)
+            jobber.fail(id, dict(error=traceback.format_exc()))
             reader_db.commit()
 
+    try:
+        for page, progress in _ocr_pages(cfg, _WORKER_PREDICTOR, pages):
+            jobber.report_progress(page.job_id, dict(progress=progress))
+            print(f"OCR job {page.job_id} at {progress:.0%}")
+
+            # Save each page as soon as it's done rather than waiting for the whole batch
+            if page.is_done:
+                try:
+                    _save_page(cfg, page)
+
+                    jobber.set_result(page.job_id, dict())
+                    reader_db.commit()
+                except:
+                    traceback.print_exc()
+
+                    jobber.fail(page.job_id, dict(error=traceback.format_exc()))
+                    reader_db.commit()
+            elif cfg.ocr_partial_results and page.has_unsaved_matches:
+                try:
+                    _save_partial_page(cfg, page)
+                except:
+                    traceback.print_exc()
+    except:
+        # Model error, retry all the unfinished pages
+        traceback.print_exc()
+
+        for page in pages:
+            if not page.is_done:
+                jobber.fail(page.job_id, dict(error=traceback.format_exc()))
+        reader_db.commit()
+
+
+@dataclass
+class _Page:
+    job_id: str
+    chap_dir: Path
+    fp_image: Path
+
+    # Resized to max_ocr_width
+    im: Image.Image
+    resize_mult: float
+
+    windows: list
+    matches: list[OcrMatch] = field(default_factory=list)
+    # Index of the window that each match came from, for dedupe_matches()
+    match_windows: list[int] = field(default_factory=list)
+    num_done: int = 0
+
+    # Matches included in the last partial save
+    num_saved_matches: int = 0
+
+    @property
+    def is_done(self) -> bool:
+        return self.num_done >= len(self.windows)
+
+    @property
+    def has_unsaved_matches(self) -> bool:
+        return len(self.matches) > self.num_saved_matches
+
+
+def _load_page(
+    cfg: Config,
+    job_id: str,
+    job: dict,
+    im: Image.Image | None = None,
+) -> _Page:
+    fp_image = Path(job["fp_image"])
+    im, resize_mult = shrink_to_width(im or open_page(fp_image), cfg.max_ocr_width)
+
+    windows = calc_windows(
+        im.size,
+        cfg.det_input_size,
+        cfg.margin_size,
+    )
+
+    return _Page(
+        job_id=job_id,
+        chap_dir=Path(job["chap_dir"]),
+        fp_image=fp_image,
+        im=im,
+        resize_mult=resize_mult,
+        windows=list(windows),
+    )
+
 
-def _process_job(
+def _ocr_pages(
     cfg: Config,
     predictor: OCRPredictor,
-    jobber: JobManager,
-    job_id: str,
-):
-    # Get job data
-    job = jobber.select(job_id)
-    print("Processing ocr job", job_id, job)
+    pages: list[_Page],
+) -> Generator[tuple[_Page, float], None, None]:
+    # Windows from all of the pages go through the models together, ocr_batch_size at a time,
+    # so that a chapter's worth of small pages doesn't underfill the batches
+    # Progress is reported for each page in a batch once the batch is done
+    #
+    # Each window is cropped once for both the blank check and the models (see record_window()),
+    # only a batch ahead so that a long strip's crops aren't all held in memory at once
+    batch: list[tuple[_Page, int, WindowCall]] = []
+    reported_done: set[int] = set()
+
+    def report(updated: list[_Page]):
+        # (keyed by id since comparing pages would compare their images)
+        for page in updated:
+            if id(page) in reported_done:
+                continue
+            if page.is_done:
+                reported_done.add(id(page))
+
+            yield page, page.num_done / max(len(page.windows), 1)
+
+    for page in pages:
+        num_blank = 0
+        for idx, w in enumerate(page.windows):
+            call = record_window(predictor, page.im, w)
+
+            # Blank windows count as done without going through the models
+            [is_blank] = find_blank_windows(
+                [call],
+                cfg.ocr_blank_max_std,
+                cfg.ocr_blank_min_edge_density,
+            )
+            if is_blank:
+                num_blank += 1
+                page.num_done += 1
+                continue
+
+            batch.append((page, idx, call))
+            if len(batch) >= cfg.ocr_batch_size:
+                yield from report(_eval_batch(predictor, batch))
+                batch = []
+
+        if num_blank:
+            print(
+                f"Skipping {num_blank} / {len(page.windows)} blank windows in {page.fp_image}"
+            )
 
-    # Generate OCR data
-    fp_image = Path(job["fp_image"])
+        yield from report([page])
 
-    ocr_iter = _ocr_page(
-        cfg,
+    if batch:
+        yield from report(_eval_batch(predictor, batch))
+
+
+def _eval_batch(
+    predictor: OCRPredictor,
+    batch: list[tuple[_Page, int, WindowCall]],
+) -> list[_Page]:
+    # Takes (page, window index, recorded window) and returns the pages that the windows belong to
+    results = eval_windows(
         predictor,
-        fp_image,
+        [(page.im, page.windows[idx]) for page, idx, _ in batch],
+        [call for _, _, call in batch],
     )
 
-    try:
-        while True:
-            progress = next(ocr_iter)
+    updated: dict[int, _Page] = dict()
+    for (page, idx, _), r in zip(batch, results):
+        page.matches.extend(r["matches"])
+        page.match_windows.extend(idx for _ in r["matches"])
+        page.num_done += 1
+        updated[id(page)] = page
+
+    return list(updated.values())
+
+
+def ocr_file(cfg: Config, predictor: OCRPredictor, fp_image: Path) -> list[OcrMatch]:
+    # OCR a single image outside of the job queue (eg for benchmarks)
+    page = _load_page(
+        cfg,
+        "",
+        dict(fp_image=str(fp_image), chap_dir=str(fp_image.parent)),
+    )
+
+    for _ in _ocr_pages(cfg, predictor, [page]):
+        pass
 
-            jobber.update_progress(job_id, dict(progress=progress))
-            jobber.db.commit()
+    return _get_page_matches(cfg, page)
 
-            print(f"OCR job {job_id} at {progress:.0%}")
-    except StopIteration as e:
-        matches = e.value
+
+def _get_page_matches(cfg: Config, page: _Page) -> list[OcrMatch]:
+    # Without the copies of words found by two overlapping windows
+    matches = dedupe_matches(
+        page.matches,
+        page.match_windows,
+        cfg.ocr_dedupe_min_overlap,
+    )
+
+    # Scaled back to the original image size
+    if page.resize_mult == 1:
+        return matches
+
+    return [_rescale(m, 1 / page.resize_mult) for m in matches]
+
+
+def _stitch_page(cfg: Config, page: _Page) -> list[dict]:
+    matches = _get_page_matches(cfg, page)
 
     # Group words into blocks (speech bubbles)
     lines = stitch_lines(matches)
-    blocks = stitch_blocks(lines)
+    return [
+        dict(value=blk.value, confidence=blk.confidence, bbox=list(blk.bbox))
+        for blk in stitch_blocks(lines)
+    ]
+
+
+def _save_partial_page(cfg: Config, page: _Page):
+    # Publish the blocks found so far so that the reader can show them before the rest of the page is done
+    # They're replaced each time, so blocks cut off by an unfinished window are fixed in a later save
+    blocks = _stitch_page(cfg, page)
+
+    chap_db = load_chapter_db(page.chap_dir)
+    _get_page_hash(chap_db, page.fp_image)
+
+    _insert_page_ocr(chap_db, page.fp_image.name, blocks, done=False)
+    page.num_saved_matches = len(page.matches)
+
+
+def _save_page(cfg: Config, page: _Page):
+    blocks = _stitch_page(cfg, page)
 
     # Insert OCR data
-    chap_db = load_chapter_db(Path(job["chap_dir"]))
+    chap_db = load_chapter_db(page.chap_dir)
+    sha256 = _get_page_hash(chap_db, page.fp_image)
+
+    _insert_page_ocr(chap_db, page.fp_image.name, blocks)
+
+    # For any copies of this page
+    cache = load_ocr_cache()
+    insert_cached_ocr(cache, sha256, get_ocr_cache_key(cfg), blocks)
+    cache.commit()
 
-    for blk in blocks:
-        insert_ocr_data(chap_db, fp_image.name, blk)
 
-    chap_db.execute(
-        """
-        UPDATE pages
-        SET done_ocr = 1
-        WHERE filename = ?
-        """,
-        [fp_image.name],
+def _copy_cached_ocr(
+    cfg: Config,
+    fp_image: Path,
+    im: Image.Image | None = None,
+) -> bool:
+    chap_db = load_chapter_db(fp_image.parent)
+
+    blocks = select_cached_ocr(
+        load_ocr_cache(),
+        _get_page_hash(chap_db, fp_image, im),
+        get_ocr_cache_key(cfg),
     )
+    if blocks is None:
+        return False
+
+    print("Copying cached ocr results for", fp_image)
+    _insert_page_ocr(chap_db, fp_image.name, blocks)
+
+    # Send them to any open readers now
+    notify_sse_hub()
 
+    return True
+
+
+def _insert_page_ocr(
+    chap_db: ChapterDb,
+    filename: str,
+    blocks: list[dict],
+    done=True,
+):
+    # Replaces any partial results
+    chap_db.execute("DELETE FROM ocr_data WHERE filename = ?", [filename])
+
+    for blk in blocks:
+        insert_ocr_block(
+            chap_db,
+            filename,
+            blk["value"],
+            blk["confidence"],
+            blk["bbox"],
+        )
+
+    if done:
+        chap_db.execute(
+            """
+            UPDATE pages
+            SET done_ocr = 1
+            WHERE filename = ?
+            """,
+            [filename],
+        )
+
+    bump_ocr_version(chap_db, filename)
     chap_db.commit()
 
 
-def _ocr_page(
-    cfg: Config,
-    predictor: OCRPredictor,
+def _get_page_hash(
+    chap_db: ChapterDb,
     fp_image: Path,
-) -> Generator[float, None, list[OcrMatch]]:
-    im = Image.open(fp_image)
+    im: Image.Image | None = None,
+) -> str:
+    page = select_page(chap_db, fp_image.name) or insert_page(chap_db, fp_image, im)
+    return page["sha256"]
 
-    resize_mult = 1
-    if im.size[0] > cfg.max_ocr_width:
-        w, h = im.size
 
-        resize_mult = cfg.max_ocr_width / w
-        new_size = (int(w * resize_mult), int(h * resize_mult))
+def get_ocr_cache_key(cfg: Config) -> str:
+    # Fingerprint of the models and settings that affect the OCR results
+    if cfg.ocr_backend == "torch":
+        model_files = [cfg.det_weights, cfg.reco_weights]
+    else:
+        model_files = get_onnx_model_paths(cfg, int8=cfg.ocr_backend == "onnx_int8")
+
+    settings = dict(
+        backend=cfg.ocr_backend,
+        det_arch=cfg.det_arch,
+        reco_arch=cfg.reco_arch,
+        model_files=[_hash_model_file(fp) for fp in model_files],
+        det_input_size=cfg.det_input_size,
+        margin_size=cfg.margin_size,
+        max_ocr_width=cfg.max_ocr_width,
+        blank_max_std=cfg.ocr_blank_max_std,
+        blank_min_edge_density=cfg.ocr_blank_min_edge_density,
+        dedupe_min_overlap=cfg.ocr_dedupe_min_overlap,
+        reco_bucket_size=cfg.ocr_reco_bucket_size,
+    )
 
-        print(f"Resizing image from {(w,h)} to {new_size}")
-        im = im.resize(new_size)
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+
+def _hash_model_file(fp: str | Path) -> str:
+    fp = Path(fp)
+    if not fp.is_file():
+        return ""
+
+    stat = fp.stat()
+    return _hash_file(fp.absolute(), stat.st_size, stat.st_mtime_ns)
 
-    windows = calc_windows(
-        im.size,
-        cfg.det_input_size,
-        cfg.margin_size,
-    )
 
-    yield 0
+@lru_cache
+def _hash_file(fp: Path, size: int, mtime_ns: int) -> str:
+    # Size / mtime are only there to invalidate the cached hash when the file changes
+    sha256 = hashlib.sha256()
+    with open(fp, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            sha256.update(chunk)
 
-    matches: list[OcrMatch] = []
-    for idx, w in enumerate(windows):
-        r = eval_window(predictor, im, w, 0)
+    return sha256.hexdigest()
 
-        matches.extend(r["matches"])
 
-        percent_done = (idx + 1) / len(windows)
-        yield percent_done
+def _init_worker(cfg: Config):
+    # Split the cores between the workers instead of having each one try to use all of them
+    if cfg.num_ocr_workers > 1 and not cfg.use_gpu_for_ocr:
+        num_threads = max(1, (os.cpu_count() or 1) // cfg.num_ocr_workers)
+        torch.set_num_threads(num_threads)
 
-    if resize_mult != 1:
-        matches = [_rescale(m, 1 / resize_mult) for m in matches]
 
-    return matches
+def load_ocr_predictor(cfg: Config, backend: str | None = None) -> OCRPredictor:
+    # The onnx backends return an onnxtr predictor, which works the same as doctr's
+    backend = backend or cfg.ocr_backend
 
+    if backend == "torch":
+        predictor = _load_torch_predictor(cfg)
+    elif backend in ["onnx", "onnx_int8"]:
+        predictor = _load_onnx_predictor(cfg, int8=backend == "onnx_int8")
+    else:
+        raise ValueError(f"Unknown OCR backend {backend}")
+
+    if cfg.ocr_reco_bucket_size > 0:
+        # Only crnn takes inputs of any width (the onnx models are exported with a fixed one)
+        narrow = backend == "torch" and cfg.reco_arch.startswith("crnn")
+        bucket_recognition(predictor, cfg.ocr_reco_bucket_size, narrow)
+
+    return predictor
 
-def _load_predictor(cfg: Config) -> OCRPredictor:
+
+def load_torch_ocr_models(cfg: Config, exportable=False) -> tuple[Any, Any]:
     det_model = doctr.models.detection.__dict__[cfg.det_arch](
         pretrained=False,
         pretrained_backbone=False,
+        exportable=exportable,
     )
     if cfg.det_weights:
         print(f"Loading detector model weights from {cfg.det_weights}")
@@ -194,6 +563,7 @@ def _load_predictor(cfg: Config) -> OCRPredictor:
         vocab=KOREAN_ALPHABET,
         pretrained=False,
         pretrained_backbone=False,
+        exportable=exportable,
     )
     if cfg.reco_weights:
         print(f"Loading recognizer model weights from {cfg.reco_weights}")
@@ -204,9 +574,27 @@ def _load_predictor(cfg: Config) -> OCRPredictor:
         )
         reco_model.load_state_dict(reco_params)
 
+    return det_model, reco_model
+
+
+def get_onnx_model_paths(cfg: Config, int8=False) -> tuple[Path, Path]:
+    # Written by scripts/export_onnx.py
+    suffix = "_int8" if int8 else ""
+    folder = Path(cfg.ocr_onnx_folder)
+
+    return (
+        folder / f"{cfg.det_arch}{suffix}.onnx",
+        folder / f"{cfg.reco_arch}{suffix}.onnx",
+    )
+
+
+def _load_torch_predictor(cfg: Config) -> OCRPredictor:
+    det_model, reco_model = load_torch_ocr_models(cfg)
+
     predictor = doctr.models.ocr_predictor(
         det_arch=det_model,
         reco_arch=reco_model,
+        det_bs=cfg.ocr_batch_size,
     )
 
     if cfg.use_gpu_for_ocr:
@@ -218,6 +606,36 @@ def _load_predictor(cfg: Config) -> OCRPredictor:
     return predictor
 
 
+def _load_onnx_predictor(cfg: Config, int8: bool) -> OCRPredictor:
+    # Optional dependency, only needed for this backend (pip install onnxtr[cpu])
+    import onnxtr.models
+
+    fp_det, fp_reco = get_onnx_model_paths(cfg, int8)
+    for fp in [fp_det, fp_reco]:
+        if not fp.exists():
+            raise FileNotFoundError(
+                f"{fp} not found, run scripts/export_onnx.py to create it"
+            )
+
+    print(f"Loading detector model from {fp_det}")
+    det_model = onnxtr.models.detection.__dict__[cfg.det_arch](str(fp_det))
+
+    print(f"Loading recognizer model from {fp_reco}")
+    reco_model = onnxtr.models.recognition.__dict__[cfg.reco_arch](
+        str(fp_reco),
+        vocab=KOREAN_ALPHABET,
+    )
+
+    predictor = onnxtr.models.ocr_predictor(
+        det_arch=det_model,
+        reco_arch=reco_model,
+        det_bs=cfg.ocr_batch_size,
+    )
+    print(f"Running OCR models on CPU with ONNX Runtime{' (int8)' if int8 else ''}")
+
+    return predictor  # type: ignore
+
+
 def _rescale(match: OcrMatch, k: float) -> OcrMatch:
     y1, x1, y2, x2 = match.bbox
     y1 = int(y1 * k)
@@ -242,6 +660,7 @@ def _unload_worker():
     print("unloading ocr model")
 
     _WORKER_PREDICTOR = None
+    emit_model_unloaded()
 
     gc.collect()
 
@@ -0,0 +1,316 @@
+import math
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+from comic_ocr.lib.inference_utils import eval_window
+from doctr.models.predictor import OCRPredictor
+from PIL import Image
+
+# Runs eval_window() on many windows (possibly from different pages) with a single model call,
+# so that the detector sees the window crops as one batch and the recognizer gets all their word crops pooled
+#
+# eval_window() crops the window, calls the predictor on it and converts the predictions to matches
+# To batch that without reimplementing it, each window goes through eval_window() twice:
+#   first with a stand-in predictor that records what the model would've been called with (and bails out)
+#   then, after one real call on all the recorded inputs, with a stand-in that returns that window's slice of the output
+# so the matches are exactly what calling eval_window() on each window would've produced
+# The recorded crops are also what the blank window check looks at, so that it doesn't crop the windows a third time
+
+# Whatever calc_windows() returns
+Window = Any
+
+# Difference between neighbouring pixels (0-255 grayscale) that counts as an edge
+_EDGE_THRESHOLD = 32
+
+# Size of the squares that the blank window stats are computed over
+_TILE_SIZE = 32
+
+# The blank window check only looks at every nth pixel in each direction,
+# converting the whole crop to floats took longer than the check itself
+# (so edges are measured between pixels this far apart)
+_SAMPLE_STEP = 4
+
+# Recognizer input size (height, width) if it can't be read off the predictor, same for all of doctr's models
+_RECO_INPUT_SIZE = (32, 128)
+
+# Narrowed recognizer inputs are rounded up to a multiple of this
+_RECO_WIDTH_STEP = 16
+
+
+@dataclass
+class WindowCall:
+    # What eval_window() calls the model with for a window (pages / kwargs)
+    # or its result if it returned without calling the model
+    pages: list | None = None
+    kwargs: dict | None = None
+    result: dict | None = None
+
+
+def record_window(predictor: OCRPredictor, im: Image.Image, w: Window) -> WindowCall:
+    # Crops / preprocesses the window (by running eval_window() up to its model call)
+    # The same crops are then used for both find_blank_windows() and eval_windows()
+    try:
+        return WindowCall(result=eval_window(_ReplayPredictor(predictor), im, w, 0))
+    except _PredictorCall as call:
+        return WindowCall(pages=call.pages, kwargs=call.kwargs)
+
+
+def eval_windows(
+    predictor: OCRPredictor,
+    items: list[tuple[Image.Image, Window]],
+    calls: list[WindowCall] | None = None,
+) -> list[dict]:
+    # calls are the windows' record_window() output, if they were already recorded
+    if calls is None:
+        calls = [record_window(predictor, im, w) for im, w in items]
+
+    results: list[dict | None] = [call.result for call in calls]
+
+    todo = [idx for idx, call in enumerate(calls) if call.result is None]
+    if not todo:
+        return results  # type: ignore
+
+    # Unbatchable (never expected, but don't guess at how to merge different options)
+    kwargs = calls[todo[0]].kwargs or dict()
+    if any(calls[idx].kwargs != kwargs for idx in todo):
+        for idx in todo:
+            im, w = items[idx]
+            results[idx] = eval_window(predictor, im, w, 0)
+        return results  # type: ignore
+
+    pages = [page for idx in todo for page in calls[idx].pages or []]
+    doc = predictor(pages, **kwargs)
+
+    # Replay each window with its share of the output
+    offset = 0
+    for idx in todo:
+        count = len(calls[idx].pages or [])
+        # (same type as the output since it may be from doctr or onnxtr)
+        window_doc = type(doc)(pages=doc.pages[offset : offset + count])
+        offset += count
+
+        im, w = items[idx]
+        replay = _ReplayPredictor(predictor, window_doc)
+        results[idx] = eval_window(replay, im, w, 0)
+
+        # If eval_window() ever calls the model differently than it was recorded, the replayed output is wrong
+        # so fall back to running that window on its own
+        if not replay.replayed_once:
+            results[idx] = eval_window(predictor, im, w, 0)
+
+    return results  # type: ignore
+
+
+def find_blank_windows(
+    calls: list[WindowCall],
+    max_std: float,
+    min_edge_density: float,
+) -> list[bool]:
+    # Flags windows that are too flat to contain any text (eg the gutters between webtoon panels)
+    # by looking at the crops that the model would be called with (see record_window())
+    # A window is blank if no part of it has a standard deviation of at least max_std
+    # or a fraction of pixels on an edge of at least min_edge_density
+    if max_std <= 0 and min_edge_density <= 0:
+        return [False] * len(calls)
+
+    return [
+        call.pages is not None
+        and all(_is_blank(page, max_std, min_edge_density) for page in call.pages)
+        for call in calls
+    ]
+
+
+def _is_blank(page: Any, max_std: float, min_edge_density: float) -> bool:
+    # Strided view of the crop, nothing is copied until the (much smaller) float conversion
+    gray = np.asarray(page)[::_SAMPLE_STEP, ::_SAMPLE_STEP].astype(np.float32)
+    if gray.ndim == 3:
+        gray = gray.mean(axis=2)
+
+    # doctr also accepts 0-1 floats
+    if gray.size and gray.max() <= 1:
+        gray = gray * 255
+
+    # Measured per tile rather than over the whole window,
+    # otherwise a single short line of text barely registers against the background
+    tile = _TILE_SIZE // _SAMPLE_STEP
+    h = gray.shape[0] // tile * tile
+    w = gray.shape[1] // tile * tile
+    if h == 0 or w == 0:
+        return True
+
+    gray = gray[:h, :w]
+
+    if max_std > 0:
+        tiles = gray.reshape(h // tile, tile, w // tile, tile)
+        if tiles.std(axis=(1, 3)).max() < max_std:
+            return True
+
+    if min_edge_density > 0:
+        edges = np.zeros(gray.shape, dtype=bool)
+        edges[:, :-1] |= np.abs(np.diff(gray, axis=1)) > _EDGE_THRESHOLD
+        edges[:-1, :] |= np.abs(np.diff(gray, axis=0)) > _EDGE_THRESHOLD
+
+        tiles = edges.reshape(h // tile, tile, w // tile, tile)
+        if tiles.mean(axis=(1, 3)).max() < min_edge_density:
+            return True
+
+    return False
+
+
+def bucket_recognition(predictor: OCRPredictor, bucket_size: int, narrow: bool):
+    # Word crops vary a lot in width, and each one is padded to the recognizer's input width
+    # This sorts them by aspect ratio and recognizes bucket_size at a time, so that each batch holds crops of similar widths,
+    # then puts the results back in the original order for stitching
+    # With narrow, each batch's input is also cut down to its widest crop instead of the full width
+    # (only for models that accept any input width, eg crnn)
+    reco = predictor.reco_predictor
+
+    # Swaps in a subclass since __call__ is looked up on the class (and torch modules don't allow replacing submodules)
+    cls = reco.__class__
+    reco.__class__ = type(f"Bucketed{cls.__name__}", (_BucketedRecognizer, cls), {})
+
+    reco.bucket_size = bucket_size
+    reco.narrow = narrow
+    reco.padding_stats = PaddingStats()
+
+
+@dataclass
+class PaddingStats:
+    # Pixels of the recognizer's input that were word crops rather than padding
+    crops: int = 0
+    content_px: float = 0
+    input_px: float = 0
+    # What the input would've been if the crops were batched in their original order, each batch narrowed to its widest crop
+    unsorted_input_px: float = 0
+
+    @property
+    def efficiency(self) -> float:
+        return self.content_px / self.input_px if self.input_px else 1
+
+    @property
+    def unsorted_efficiency(self) -> float:
+        return self.content_px / self.unsorted_input_px if self.unsorted_input_px else 1
+
+
+class _BucketedRecognizer:
+    # Mixed into the recognizer's class by bucket_recognition()
+    bucket_size: int
+    narrow: bool
+    padding_stats: PaddingStats
+
+    def __call__(self, crops: list, **kwargs) -> list:
+        if not len(crops):
+            return super().__call__(crops, **kwargs)  # type: ignore
+
+        resize = self._get_resize()
+        height, width = resize.size if resize else _RECO_INPUT_SIZE
+        narrow = self.narrow and resize is not None
+
+        aspects = [_get_aspect(crop) for crop in crops]
+        order = sorted(range(len(crops)), key=lambda idx: aspects[idx])
+
+        results: list[Any] = [None] * len(crops)
+        input_px = 0
+        for bucket in _split(order, self.bucket_size):
+            bucket_width = width
+            if narrow:
+                bucket_aspects = [aspects[idx] for idx in bucket]
+                bucket_width = _get_batch_width(bucket_aspects, height, width)
+
+            bucket_crops = [crops[idx] for idx in bucket]
+            output = self._recognize(bucket_crops, bucket_width, **kwargs)
+            for idx, out in zip(bucket, output):
+                results[idx] = out
+
+            input_px += len(bucket) * height * bucket_width
+
+        stats = self.padding_stats
+        stats.crops += len(crops)
+        stats.content_px += sum(_get_content_px(a, height, width) for a in aspects)
+        stats.input_px += input_px
+        for batch in _split(aspects, self.bucket_size):
+            batch_width = _get_batch_width(batch, height, width)
+            stats.unsorted_input_px += len(batch) * height * batch_width
+
+        return results
+
+    def _recognize(self, crops: list, input_width: int, **kwargs) -> list:
+        resize = self._get_resize()
+        if resize is None or input_width == resize.size[1]:
+            return super().__call__(crops, **kwargs)  # type: ignore
+
+        # The crops are resized (keeping their aspect ratio) and padded to resize.size
+        full_size = resize.size
+        resize.size = (full_size[0], input_width)
+        try:
+            return super().__call__(crops, **kwargs)  # type: ignore
+        finally:
+            resize.size = full_size
+
+    def _get_resize(self) -> Any:
+        # doctr's PreProcessor (onnxtr's stores its size differently, and the onnx models have a fixed width anyway)
+        resize = getattr(getattr(self, "pre_processor", None), "resize", None)
+        size = getattr(resize, "size", None)
+        if not isinstance(size, (tuple, list)) or len(size) != 2:
+            return None
+
+        return resize
+
+
+def _split(items: list, size: int) -> list[list]:
+    return [items[start : start + size] for start in range(0, len(items), size)]
+
+
+def _get_aspect(crop: Any) -> float:
+    # Crops are HWC arrays
+    h, w = crop.shape[:2]
+    return w / max(h, 1)
+
+
+def _get_batch_width(aspects: list[float], height: int, width: int) -> int:
+    # Narrowest input that fits the widest crop at full height
+    widest = max(aspects) * height
+    widest = math.ceil(widest / _RECO_WIDTH_STEP) * _RECO_WIDTH_STEP
+    return min(max(widest, height), width)
+
+
+def _get_content_px(aspect: float, height: int, width: int) -> float:
+    # Area of the crop once it's resized to fit the input
+    if aspect * height <= width:
+        return height * aspect * height
+
+    return width * width / aspect
+
+
+# BaseException so that it gets past any "except Exception" in eval_window()
+class _PredictorCall(BaseException):
+    def __init__(self, pages: list, kwargs: dict):
+        self.pages = pages
+        self.kwargs = kwargs
+
+
+class _ReplayPredictor:
+    # Stand-in for the predictor passed to eval_window()
+
+    def __init__(self, predictor: OCRPredictor, result: Any = None):
+        self._predictor = predictor
+        self._result = result
+        self._num_calls = 0
+        self._num_pages = 0
+
+    def __call__(self, pages, **kwargs) -> Any:
+        if self._result is None:
+            raise _PredictorCall(list(pages), kwargs)
+
+        self._num_calls += 1
+        self._num_pages = len(pages)
+        return self._result
+
+    @property
+    def replayed_once(self) -> bool:
+        # Called exactly once, with as many pages as were recorded
+        return self._num_calls == 1 and self._num_pages == len(self._result.pages)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._predictor, name)
@@ -0,0 +1,92 @@
+from comic_ocr.lib.label_utils import OcrMatch
+
+# Windows overlap by margin_size, so words near a window's edge are usually found by both windows
+# This drops the extra copies before they're stitched into lines / blocks
+#
+# Only matches from different windows are compared,
+# since overlapping matches from the same window are real (eg furigana over a word, or text drawn over SFX)
+#
+# Matches are bucketed into a grid so that each one is only compared against its neighbours
+# instead of every other match on the page (which adds up on long strips with thousands of matches)
+
+Bbox = tuple[int, int, int, int]
+
+
+def dedupe_matches(
+    matches: list[OcrMatch],
+    windows: list[int],
+    min_overlap: float,
+) -> list[OcrMatch]:
+    # windows holds the index of the window that each match came from
+    # Two matches are copies if they're from different windows
+    # and their intersection covers at least min_overlap of the smaller one
+    # Returns the remaining matches in their original order
+    if min_overlap <= 0 or len(matches) < 2:
+        return list(matches)
+
+    cell_size = _get_cell_size(matches)
+    grid: dict[tuple[int, int], list[int]] = dict()
+
+    # Biggest first, so that a word cut off by the edge of one window loses to the whole copy from the next
+    order = sorted(
+        range(len(matches)),
+        key=lambda idx: (_area(matches[idx].bbox), matches[idx].confidence),
+        reverse=True,
+    )
+
+    kept: list[int] = []
+    for idx in order:
+        bbox = matches[idx].bbox
+        cells = _get_cells(bbox, cell_size)
+
+        neighbours = {
+            other
+            for c in cells
+            for other in grid.get(c, [])
+            if windows[other] != windows[idx]
+        }
+        if any(
+            _get_overlap(bbox, matches[other].bbox) >= min_overlap
+            for other in neighbours
+        ):
+            continue
+
+        kept.append(idx)
+        for c in cells:
+            grid.setdefault(c, []).append(idx)
+
+    kept.sort()
+    return [matches[idx] for idx in kept]
+
+
+def _get_cell_size(matches: list[OcrMatch]) -> int:
+    # About the size of a typical match so that most of them fall into 1-4 cells
+    sizes = sorted(max(y2 - y1, x2 - x1) for y1, x1, y2, x2 in (m.bbox for m in matches))
+    return max(sizes[len(sizes) // 2], 1)
+
+
+def _get_cells(bbox: Bbox, cell_size: int) -> list[tuple[int, int]]:
+    y1, x1, y2, x2 = bbox
+
+    return [
+        (row, col)
+        for row in range(y1 // cell_size, y2 // cell_size + 1)
+        for col in range(x1 // cell_size, x2 // cell_size + 1)
+    ]
+
+
+def _get_overlap(a: Bbox, b: Bbox) -> float:
+    ay1, ax1, ay2, ax2 = a
+    by1, bx1, by2, bx2 = b
+
+    h = min(ay2, by2) - max(ay1, by1)
+    w = min(ax2, bx2) - max(ax1, bx1)
+    if h <= 0 or w <= 0:
+        return 0
+
+    return h * w / max(min(_area(a), _area(b)), 1)
+
+
+def _area(bbox: Bbox) -> int:
+    y1, x1, y2, x2 = bbox
+    return max(y2 - y1, 0) * max(x2 - x1, 0)
@@ -0,0 +1,58 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# Decoding page images for OCR and hashing
+#
+# Pages are opened lazily so that a page that's about to be shrunk for OCR can be decoded straight to
+# (roughly) the smaller size, which JPEGs support (draft mode), instead of decoding at full size and then resizing
+# A page that also needs to be hashed is decoded once (at full size) and the same pixels are used for both
+
+# Modes where the raw bytes are exactly what np.array(im) would contain
+_UINT8_MODES = ["L", "LA", "P", "RGB", "RGBA", "CMYK"]
+
+# Rows hashed at a time, instead of copying the whole image into one buffer
+_HASH_CHUNK_ROWS = 1024
+
+
+def open_page(fp: Path) -> Image.Image:
+    # Only reads the header, the pixels are decoded on first use
+    return Image.open(fp)
+
+
+def shrink_to_width(im: Image.Image, max_width: int) -> tuple[Image.Image, float]:
+    # Returns the (possibly) resized image and its scale relative to the original
+    w, h = im.size
+    if w <= max_width:
+        return im, 1
+
+    resize_mult = max_width / w
+    new_size = (int(w * resize_mult), int(h * resize_mult))
+
+    # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale for a fraction of the work
+    # This only picks a scale that's still at least new_size and does nothing if the image was already decoded
+    im.draft(None, new_size)
+
+    print(f"Resizing image from {(w,h)} to {new_size}")
+
+    # reducing_gap shrinks by an integer factor first (much faster on very long strips)
+    # the result is practically the same as resizing in one go
+    return im.resize(new_size, reducing_gap=3.0), resize_mult
+
+
+def hash_pixels(im: Image.Image) -> str:
+    # sha256 of the decoded pixels, as stored in the chapter db's pages table
+    if im.mode not in _UINT8_MODES:
+        arr = np.array(im).astype(np.uint8)
+        return hashlib.sha256(arr.tobytes()).hexdigest()
+
+    sha256 = hashlib.sha256()
+
+    w, h = im.size
+    for top in range(0, h, _HASH_CHUNK_ROWS):
+        bottom = min(top + _HASH_CHUNK_ROWS, h)
+        sha256.update(im.crop((0, top, w, bottom)).tobytes())
+
+    return sha256.hexdigest()
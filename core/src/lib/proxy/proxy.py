@@ -6,14 +6,12 @@ import requests
 
 from ..config import Config
 from ..db.reader_db import ReaderDb, load_reader_db
-from ..job_utils import JobManager, start_job_worker
+from ..job_utils import JobManager, JobRetention, start_job_worker
 from ..paths import LOG_DIR
 from .request_log import RequestLog
 
 PROXY_JOB_TYPE = "proxy"
 
-_REQ_LOG = RequestLog()
-
 loguru.logger.add(
     LOG_DIR / "proxy.log",
     filter=lambda record: record["extra"].get("name") == "proxy",
@@ -28,7 +26,10 @@ def start_proxy_job_worker(cfg: Config):
         cfg,
         PROXY_JOB_TYPE,
         _process_all_jobs,
-        delay=0.1,
+        num_workers=cfg.num_proxy_workers,
+        # Results contain whole response bodies (eg cover images)
+        retention=JobRetention(max_age_seconds=600, max_result_bytes=50_000_000),
+        job_timeout=cfg.proxy_job_timeout_seconds,
     )
 
 
@@ -67,7 +68,8 @@ def _process_all_jobs(cfg: Config, job_ids: list[str]):
         except:
             traceback.print_exc()
 
-            jobber.set_error(
+            # Retry job on error (eg connection reset)
+            jobber.fail(
                 id,
                 dict(error=traceback.format_exc()),
             )
@@ -82,14 +84,13 @@ def _process_job(
     job = jobber.select(job_id)
     _LOGGER.info(f"Processing proxy job {job_id}")
 
-    _REQ_LOG.wait_limit(job["url"], job["rate_limit"])
+    RequestLog(jobber.db).wait_limit(job["url"], job["rate_limit"])
 
     headers = dict()
     if job["user_agent"]:
         headers["User-Agent"] = job["user_agent"]
 
     resp = requests.get(job["url"], headers=headers)
-    _REQ_LOG.add(job["url"])
 
     return dict(
         status_code=resp.status_code,
@@ -2,53 +2,69 @@ import time
 
 from yarl import URL
 
+from ..db.reader_db import ReaderDb
+
 
 class RequestLog:
-    def __init__(self, purge_after_seconds=300, check_delay=0.1):
+    # Recent requests per origin, kept in the reader db
+    # so that the rate limits hold across every proxy worker (and every process running them)
+    def __init__(self, db: ReaderDb, purge_after_seconds=300, check_delay=0.1):
+        self.db = db
         self.purge_after_seconds = purge_after_seconds
         self.check_delay = check_delay
 
-        self.history: dict[str, list[float]] = dict()
-
-    def add(self, url: str):
-        key = self.get_key(url)
-
-        self.history.setdefault(key, [])
-        self.history[key].append(time.time())
-
-    def purge(self):
-        cutoff = time.time() - self.purge_after_seconds
-
-        for log_key, log in self.history.items():
-            idx_stop = 0
-            for idx_stop, t in enumerate(log):
-                if t > cutoff:
-                    break
-
-            if idx_stop > 0:
-                self.history[log_key] = log[:idx_stop]
-
     def wait_limit(self, url: str, per_second_limit: int):
+        # Blocks until the origin is under its limit, then records the request
+        # Checked and recorded under the db's write lock so that two workers can't both take the last slot
         key = self.get_key(url)
-
-        recent = self._get_recent(key, 1)
-        if len(recent) >= per_second_limit:
-            until = recent[-per_second_limit] + 1
-            delay = time.time() - until
-            time.sleep(delay)
-
-        return
-
-    def _get_recent(self, key: str, threshold: float):
-        cutoff = time.time() - threshold
-
-        reqs = []
-        for t in reversed(self.history.get(key, [])):
-            if t < cutoff:
-                break
-            reqs.append(t)
-
-        return reqs
+        if per_second_limit <= 0:
+            return
+
+        while True:
+            self.db.execute("BEGIN IMMEDIATE")
+
+            try:
+                now = time.time()
+                recent = self._get_recent(key, now - 1)
+
+                if len(recent) < per_second_limit:
+                    self.db.execute(
+                        """
+                        INSERT INTO proxy_requests (origin, requested_at)
+                        VALUES (?, ?)
+                        """,
+                        [key, now],
+                    )
+                    self._purge(key, now)
+                    self.db.commit()
+                    return
+
+                self.db.rollback()
+            except:
+                self.db.rollback()
+                raise
+
+            until = recent[per_second_limit - 1] + 1
+            time.sleep(max(until - now, self.check_delay))
+
+    def _get_recent(self, key: str, cutoff: float) -> list[float]:
+        # Newest first
+        rs = self.db.execute(
+            """
+            SELECT requested_at FROM proxy_requests
+            WHERE origin = ? AND requested_at >= ?
+            ORDER BY requested_at DESC
+            """,
+            [key, cutoff],
+        ).fetchall()
+
+        return [r["requested_at"] for r in rs]
+
+    def _purge(self, key: str, now: float):
+        self.db.execute(
+            "DELETE FROM proxy_requests WHERE origin = ? AND requested_at < ?",
+            [key, now - self.purge_after_seconds],
+        )
 
     def get_key(self, url_str: str) -> str:
         return str(URL(url_str).origin())
@@ -1,11 +1,15 @@
-import asyncio
+from typing import Literal
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi_cache.decorator import cache
+from pydantic import BaseModel
 
+from ..config import Config
 from ..db.llm_cache import load_llm_cache, select_best_defs, select_translation
 from ..db.reader_db import load_reader_db
-from ..llm.llm_worker import insert_llm_job
+from ..job_utils import PRIORITY_INTERACTIVE
+from ..llm.llm_worker import bump_llm_job, insert_llm_job, wait_llm_job
 
 router = APIRouter()
 
@@ -16,15 +20,18 @@ async def get_mtl(req: Request, text: str):
     if not req.app.state.cfg.use_llm_for_mtl:
         return None
 
-    cache = load_llm_cache()
-
-    translation = select_translation(cache, text)
+    translation = await run_in_threadpool(_select_or_insert_job, text, "mtl")
     if translation is None:
-        insert_llm_job(load_reader_db(), text, "mtl")
+        try:
+            _, error = await wait_llm_job(text, "mtl")
+        except KeyError:
+            # Job was purged before it was done
+            raise HTTPException(503)
+
+        if error:
+            raise HTTPException(500)
 
-    while not translation:
-        await asyncio.sleep(1)
-        translation = select_translation(cache, text)
+        translation = await run_in_threadpool(_select_cached, text, "mtl")
 
     return translation
 
@@ -35,14 +42,63 @@ async def get_best_defs(req: Request, text: str):
     if not req.app.state.cfg.use_llm_for_definition_sort:
         return None
 
-    cache = load_llm_cache()
-
-    best = select_best_defs(cache, text)
+    best = await run_in_threadpool(_select_or_insert_job, text, "best_defs")
     if best is None:
-        insert_llm_job(load_reader_db(), text, "best_defs")
+        try:
+            _, error = await wait_llm_job(text, "best_defs")
+        except KeyError:
+            # Job was purged before it was done
+            raise HTTPException(503)
 
-    while not best:
-        await asyncio.sleep(1)
-        best = select_best_defs(cache, text)
+        if error:
+            raise HTTPException(500)
+
+        best = await run_in_threadpool(_select_cached, text, "best_defs")
 
     return best
+
+
+def _select_or_insert_job(text: str, type: Literal["mtl", "best_defs"]):
+    # Queues a job if the result isn't cached yet
+    # (run in a thread since the db calls can wait on the workers' write locks)
+    cached = _select_cached(text, type)
+    if cached is None:
+        insert_llm_job(load_reader_db(), text, type)
+
+    return cached
+
+
+def _select_cached(text: str, type: Literal["mtl", "best_defs"]):
+    cache = load_llm_cache()
+
+    if type == "mtl":
+        return select_translation(cache, text)
+    else:
+        return select_best_defs(cache, text)
+
+
+class BumpLlmRequest(BaseModel):
+    text: str
+    type: Literal["mtl", "best_defs"]
+
+
+@router.patch("/llm/bump")
+def bump_llm_request(req: Request, body: BumpLlmRequest):
+    # Move a request to the front of the LLM queue (eg because the user is looking at it)
+    cfg: Config = req.app.state.cfg
+    cache = load_llm_cache()
+
+    if body.type == "mtl":
+        if not cfg.use_llm_for_mtl:
+            return False
+        if select_translation(cache, body.text) is not None:
+            return False
+    else:
+        if not cfg.use_llm_for_definition_sort:
+            return False
+        if select_best_defs(cache, body.text) is not None:
+            return False
+
+    db = load_reader_db()
+    insert_llm_job(db, body.text, body.type, priority=PRIORITY_INTERACTIVE)
+    return bump_llm_job(db, body.text, body.type)
@@ -0,0 +1,31 @@
+from typing import Literal
+
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+
+from ..metrics import collect_metrics, dump_metrics, dump_metrics_prometheus
+from ..model_residency import get_residency_state
+
+router = APIRouter()
+
+
+# async so that the metrics are dumped on the event loop thread, which is where they're updated
+# The collectors query the db so they run in the threadpool instead
+@router.get("/metrics")
+async def metrics(format: Literal["json", "prometheus"] = "json"):
+    await run_in_threadpool(collect_metrics)
+
+    if format == "prometheus":
+        return PlainTextResponse(
+            dump_metrics_prometheus(),
+            media_type="text/plain; version=0.0.4",
+        )
+
+    return dump_metrics()
+
+
+@router.get("/metrics/models")
+def model_residency():
+    # Which workers have their model loaded, and how much of the memory budget they use
+    return get_residency_state()
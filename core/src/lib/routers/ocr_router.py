@@ -1,5 +1,3 @@
-import asyncio
-import json
 from pathlib import Path
 from typing import Annotated
 
@@ -14,8 +12,9 @@ from ..db.chapter_db import (
     update_ocr_text,
 )
 from ..db.reader_db import load_reader_db
-from ..misc_utils import sanitize_or_raise_400
-from ..ocr import get_all_ocr_data, insert_ocr_job
+from ..misc_utils import dump_sse_event, sanitize_or_raise_400
+from ..ocr import bump_ocr_job, get_all_ocr_data, insert_ocr_job
+from ..sse_hub import subscribe
 from . import EDIT_LOGGER
 
 router = APIRouter()
@@ -34,8 +33,12 @@ def ocr_for_chapter(req: Request, series: str, chapter: str):
 
     missing = [fp_image for fp_image in data if data[fp_image] is None]
     missing.sort()
+
+    reader_db = load_reader_db()
     for fp_image in missing:
-        insert_ocr_job(load_reader_db(), fp_image)
+        if not insert_ocr_job(req.app.state.cfg, reader_db, fp_image):
+            # Copied from the OCR cache
+            data[fp_image] = select_ocr_data(load_chapter_db(chap_dir), fp_image.name)
 
     resp = {fp_image.name: pg_data for fp_image, pg_data in data.items()}
     return resp
@@ -63,28 +66,149 @@ def poll_ocr(
             raise HTTPException(404)
 
     async def poll():
-        db = load_chapter_db(chap_dir)
+        # Version of each page's data that was last sent
+        sent_done: dict[str, int] = dict()
+        sent_partial: dict[str, int] = dict()
+
+        async for state in subscribe(
+            ("ocr", str(chap_dir)),
+            lambda: _ChapterOcrSource(chap_dir),
+        ):
+            done = state["done"]
+            partial = state["partial"]
+
+            # Send every newly finished (or since edited) page in one update
+            update = _get_changed(pages, done, sent_done)
+            if update:
+                yield dump_sse_event(dict(type="ocr", value=update))
+
+            # Likewise for pages with new partial results
+            partial_update = _get_changed(
+                [filename for filename in pages if filename not in sent_done],
+                partial,
+                sent_partial,
+            )
+            if partial_update:
+                yield dump_sse_event(dict(type="ocr_partial", value=partial_update))
+
+            if len(sent_done) == len(set(pages)):
+                break
+
+        yield "data: close\n\n"
 
-        pages_to_poll = pages.copy()
-        pages_to_poll.sort()
+    return StreamingResponse(poll(), media_type="text/event-stream")
 
-        while pages_to_poll:
-            fst = pages_to_poll[0]
 
-            data = select_ocr_data(db, fst)
-            if not data:
-                await asyncio.sleep(1)
+def _get_changed(
+    pages: list[str],
+    latest: dict[str, dict],
+    sent: dict[str, int],
+) -> dict[str, dict]:
+    # Data of the pages whose version changed since it was last sent, and marks them as sent
+    changed = {
+        filename: latest[filename]
+        for filename in pages
+        if filename in latest and sent.get(filename) != latest[filename]["version"]
+    }
+
+    for filename, page in changed.items():
+        sent[filename] = page["version"]
+
+    return {filename: page["data"] for filename, page in changed.items()}
+
+
+class _ChapterOcrSource:
+    # Shared by every client reading the same chapter
+    # Only the pages whose OCR data changed since the last poll (finished, new partial results, edited) are loaded
+    # Pages are tracked as dict(version=ocr_version, data=...)
+
+    def __init__(self, chap_dir: Path):
+        self.db = load_chapter_db(chap_dir)
+        self.done: dict[str, dict] = dict()
+        self.partial: dict[str, dict] = dict()
+
+        # (done_ocr, ocr_version) of each page as of the last time it was loaded
+        self.loaded: dict[str, tuple[bool, int]] = dict()
+
+    def poll(self) -> dict | None:
+        rs = self.db.execute(
+            """
+            SELECT filename, done_ocr, ocr_version AS version
+            FROM pages
+            """
+        ).fetchall()
+
+        changed = False
+        for r in rs:
+            filename = r["filename"]
+            key = (bool(r["done_ocr"]), r["version"])
+            if self.loaded.get(filename) == key:
                 continue
 
-            resp = dict(filename=fst, data=data)
-            resp = "data: " + json.dumps(resp) + "\n\n"
-            yield resp
+            if r["done_ocr"]:
+                data = select_ocr_data(self.db, filename)
+                if data is None:
+                    continue
 
-            pages_to_poll.pop(0)
+                self.done[filename] = dict(version=r["version"], data=data)
+                self.partial.pop(filename, None)
+            else:
+                # No partial results yet
+                if not r["version"]:
+                    continue
 
-        yield "data: close\n\n"
+                data = select_ocr_data(self.db, filename, partial=True)
+                if data is None:
+                    continue
 
-    return StreamingResponse(poll(), media_type="text/event-stream")
+                self.partial[filename] = dict(version=r["version"], data=data)
+                self.done.pop(filename, None)
+
+            self.loaded[filename] = key
+            changed = True
+
+        # Deleted pages
+        filenames = {r["filename"] for r in rs}
+        for filename in list(self.loaded):
+            if filename not in filenames:
+                del self.loaded[filename]
+                self.done.pop(filename, None)
+                self.partial.pop(filename, None)
+                changed = True
+
+        if not changed:
+            return None
+
+        # Copies since the subscribers read them on another thread
+        return dict(done=dict(self.done), partial=dict(self.partial))
+
+    def close(self):
+        self.db.close()
+
+
+class BumpPageRequest(BaseModel):
+    series: str
+    chapter: str
+    page: str
+
+
+@router.patch("/ocr/bump")
+def bump_page(req: Request, body: BumpPageRequest):
+    # Move a page to the front of the OCR queue (eg because it's on screen)
+    series = sanitize_or_raise_400(body.series)
+    chapter = sanitize_or_raise_400(body.chapter)
+    page = sanitize_or_raise_400(body.page)
+
+    chap_dir: Path = req.app.state.cfg.root_image_folder / series / chapter
+    fp_image = chap_dir / page
+    if not fp_image.exists():
+        raise HTTPException(404)
+
+    # Already done
+    if select_ocr_data(load_chapter_db(chap_dir), page) is not None:
+        return False
+
+    return bump_ocr_job(req.app.state.cfg, load_reader_db(), fp_image)
 
 
 class UpdateBlockTextRequest(BaseModel):
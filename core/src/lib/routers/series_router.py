@@ -1,4 +1,3 @@
-import asyncio
 import base64
 import json
 import re
@@ -8,6 +7,7 @@ from pathlib import Path
 
 from fastapi import (APIRouter, File, Form, HTTPException, Request, Response,
                      UploadFile)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, StreamingResponse
 from PIL import Image
 from pydantic import BaseModel
@@ -17,12 +17,14 @@ from ..db.chapter_db import load_chapter_db, update_chapter
 from ..db.reader_db import load_reader_db
 from ..db.series_db import load_series_db, update_series
 from ..job_utils import JobManager, wait_job
-from ..misc_utils import dump_sse_event, sanitize_or_raise_400
+from ..misc_utils import diff_dict, dump_sse_event, sanitize_or_raise_400
+from ..ocr import prefetch_ocr
 from ..proxy.proxy import PROXY_JOB_TYPE, insert_proxy_job
 from ..series import (apply_chapter_crud, count_file_types, create_series,
                       get_all_chapters, get_all_pages, get_all_series,
                       get_chapter, get_series, raise_on_size_limit,
                       upsert_cover, validate_image_upload)
+from ..sse_hub import subscribe
 from ..url_import import IMPORT_JOB_TYPE, insert_import_job
 from . import EDIT_LOGGER
 
@@ -268,13 +270,17 @@ def create_chapter(
             )
 
     chap_dir.mkdir()
+    fp_pages = []
     for pg in to_create:
         fp = chap_dir / f'{pg["filename"]}.png'
         pg["im"].save(fp)
+        fp_pages.append(fp)
 
     db = load_chapter_db(chap_dir)
     update_chapter(db, chapterName)
 
+    prefetch_ocr(cfg, fp_pages)
+
     info = get_chapter(cfg, series, chapter_filename)
     EDIT_LOGGER.info(f"Created {series} chapter {info}")
 
@@ -388,6 +394,8 @@ def edit_chapter(
         name=name or None,
     )
 
+    prefetch_ocr(cfg, [pg["fp"] for pg in to_add])
+
     info = get_chapter(cfg, series, chapter)
     EDIT_LOGGER.info(f"Updated {series} chapter {info}")
 
@@ -475,6 +483,8 @@ def add_page(req: Request, series: str, chapter: str, page: UploadFile):
 
     EDIT_LOGGER.info(f"Added page to {series} chapter {chapter}")
 
+    prefetch_ocr(cfg, [fp_page])
+
     return get_all_pages(cfg, series, chapter)
 
 
@@ -632,175 +642,168 @@ def import_chapter(req: Request, body: ImportChapterRequest):
 @router.get("/import_chapter/{job_id}")
 def import_chapter_progress(req: Request, job_id: str):
     async def poll():
-        db = load_reader_db()
-        jobber = JobManager(db, IMPORT_JOB_TYPE)
+        is_first = True
+        prev_position = None
+        prev_progress = None
 
-        # Wait for job to be created
-        while (job := jobber.select(job_id, None)) is None:
-            await asyncio.sleep(1)
-
-        # Notify metadata
-        yield dump_sse_event(
-            dict(
-                type="metadata",
-                value=dict(
-                    urls=job["urls"],
-                    chapter=Path(job["chap_dir"]).name,
-                    series=Path(job["chap_dir"]).parent.name,
-                ),
-            )
-        )
+        async for state in subscribe(
+            ("import_chapter", job_id),
+            lambda: _ImportProgressSource(job_id),
+        ):
+            # Notify metadata
+            if is_first:
+                yield dump_sse_event(dict(type="metadata", value=state["metadata"]))
+                is_first = False
+
+            # Notify queue position
+            position = state["position"]
+            if position and position != prev_position:
+                yield dump_sse_event(dict(type="position", value=position))
+            prev_position = position
+
+            # Notify progress (only the changes after the first update)
+            progress = state["progress"]
+            if progress and prev_progress is None:
+                yield dump_sse_event(dict(type="progress", value=progress))
+            elif progress and progress != prev_progress:
+                yield dump_sse_event(
+                    dict(type="progress_diff", value=diff_dict(prev_progress, progress))
+                )
+            prev_progress = progress or prev_progress
 
-        # Notify queue position
-        while True:
-            pos = jobber.select_queue_position(job_id)
-            if pos == 0:
+            if state["done"]:
                 break
 
-            yield dump_sse_event(
-                dict(
-                    type="position",
-                    value=pos,
-                )
+        yield "data: close\n\n"
+
+    return StreamingResponse(poll(), media_type="text/event-stream")
+
+
+class _ImportProgressSource:
+    # Shared by every client watching the same import job
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.db = load_reader_db()
+        self.jobber = JobManager(self.db, IMPORT_JOB_TYPE)
+
+        self.metadata: dict | None = None
+        self.state: dict | None = None
+
+    def poll(self) -> dict | None:
+        # Wait for job to be created
+        if self.metadata is None:
+            job = self.jobber.select(self.job_id, None)
+            if job is None:
+                return None
+
+            self.metadata = dict(
+                urls=job["urls"],
+                chapter=Path(job["chap_dir"]).name,
+                series=Path(job["chap_dir"]).parent.name,
             )
-            await asyncio.sleep(3)
 
-        # Notify progress
-        while True:
-            # Job was maybe deleted
-            r = jobber.select_progress(job_id)
-            if r is None:
-                break
+        state = dict(
+            metadata=self.metadata,
+            position=None,
+            progress=None,
+            done=False,
+        )
 
-            # Job just started
+        r = self.jobber.select_progress(self.job_id)
+        if r is None:
+            # Job was deleted
+            state["done"] = True
+        else:
             progress, done_at = r
-            if not len(progress):
-                await asyncio.sleep(1)
-                continue
+            state["progress"] = progress or None
+            state["done"] = done_at
 
-            yield dump_sse_event(dict(type="progress", value=progress))
+            # Job hasn't started yet
+            if not progress and not done_at:
+                state["position"] = self.jobber.select_queue_position(self.job_id)
 
-            if done_at:
-                break
-            else:
-                await asyncio.sleep(0.5)
+        if state == self.state:
+            return None
 
-        yield "data: close\n\n"
+        self.state = state
+        return state
 
-    return StreamingResponse(poll(), media_type="text/event-stream")
+    def close(self):
+        self.db.close()
 
 
 @router.get("/proxy/mangadex/{rest:path}")
-def proxy_mangadex_api(req: Request, rest: str):
-    db = load_reader_db()
+async def proxy_mangadex_api(req: Request, rest: str):
     cfg: Config = req.app.state.cfg
 
-    url = f"https://api.mangadex.org/{rest}"
-    job_id = insert_proxy_job(
-        db,
-        url,
+    return await _proxy_request(
+        f"https://api.mangadex.org/{rest}",
         cfg.max_mangadex_requests_per_second,
         user_agent="https://github.com/LiteralGenie/reader",
     )
-    result, error = wait_job(
-        JobManager(db, PROXY_JOB_TYPE),
-        job_id,
-        delay=0.1,
-    )
-
-    if result and result["status_code"] == 200:
-        return Response(
-            status_code=result["status_code"],
-            content=base64.b64decode(result["body"]),
-            # headers=result["headers"],
-        )
-    elif result:
-        raise HTTPException(result["status_code"], result)
-    else:
-        raise HTTPException(500)
 
 
 @router.get("/proxy/mangadex_cover/{manga_id}/{cover_filename}")
-def proxy_mangadex_cover(req: Request, manga_id: str, cover_filename: str):
-    db = load_reader_db()
+async def proxy_mangadex_cover(req: Request, manga_id: str, cover_filename: str):
     cfg: Config = req.app.state.cfg
 
-    url = f"https://uploads.mangadex.org/covers/{manga_id}/{cover_filename}"
-    job_id = insert_proxy_job(
-        db,
-        url,
+    return await _proxy_request(
+        f"https://uploads.mangadex.org/covers/{manga_id}/{cover_filename}",
         cfg.max_mangadex_requests_per_second,
         user_agent="https://github.com/LiteralGenie/reader",
+        forward_headers=True,
     )
-    result, error = wait_job(
-        JobManager(db, PROXY_JOB_TYPE),
-        job_id,
-        delay=0.1,
-    )
-
-    if result and result["status_code"] == 200:
-        return Response(
-            status_code=result["status_code"],
-            content=base64.b64decode(result["body"]),
-            headers=result["headers"],
-        )
-    elif result:
-        raise HTTPException(result["status_code"], result)
-    else:
-        raise HTTPException(500)
 
 
 @router.get("/proxy/mangaupdates/{rest:path}")
-def proxy_mangaupdates_api(req: Request, rest: str):
-    db = load_reader_db()
+async def proxy_mangaupdates_api(req: Request, rest: str):
     cfg: Config = req.app.state.cfg
 
-    url = f"https://api.mangaupdates.com/v1/{rest}"
-    job_id = insert_proxy_job(
-        db,
-        url,
+    return await _proxy_request(
+        f"https://api.mangaupdates.com/v1/{rest}",
         cfg.max_bakaupdate_requests_per_second,
     )
-    result, error = wait_job(
-        JobManager(db, PROXY_JOB_TYPE),
-        job_id,
-        delay=0.1,
-    )
-
-    if result and result["status_code"] == 200:
-        return Response(
-            status_code=result["status_code"],
-            content=base64.b64decode(result["body"]),
-            # headers=result["headers"],
-        )
-    elif result:
-        raise HTTPException(result["status_code"], result)
-    else:
-        raise HTTPException(500)
 
 
 @router.get("/proxy/mangaupdates_cover/{rest:path}")
-def proxy_mangaupdates_cover(req: Request, rest: str):
-    db = load_reader_db()
+async def proxy_mangaupdates_cover(req: Request, rest: str):
     cfg: Config = req.app.state.cfg
 
-    url = f"https://cdn.mangaupdates.com/{rest}"
-    job_id = insert_proxy_job(
-        db,
-        url,
+    return await _proxy_request(
+        f"https://cdn.mangaupdates.com/{rest}",
         cfg.max_bakaupdate_requests_per_second,
+        forward_headers=True,
     )
-    result, error = wait_job(
-        JobManager(db, PROXY_JOB_TYPE),
-        job_id,
-        delay=0.1,
+
+
+async def _proxy_request(
+    url: str,
+    rate_limit: int,
+    user_agent: str | None = None,
+    forward_headers=False,
+):
+    # The db calls can wait (up to busy_timeout) on the workers' write locks, so keep them off the event loop
+    job_id = await run_in_threadpool(
+        lambda: insert_proxy_job(
+            load_reader_db(),
+            url,
+            rate_limit,
+            user_agent=user_agent,
+        )
     )
 
+    try:
+        result, error = await wait_job(PROXY_JOB_TYPE, job_id)
+    except KeyError:
+        # Purged before it was done
+        raise HTTPException(503)
+
     if result and result["status_code"] == 200:
         return Response(
             status_code=result["status_code"],
             content=base64.b64decode(result["body"]),
-            headers=result["headers"],
+            headers=result["headers"] if forward_headers else None,
         )
     elif result:
         raise HTTPException(result["status_code"], result)
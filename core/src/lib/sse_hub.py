@@ -0,0 +1,172 @@
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, Hashable, Protocol
+
+from .worker_events import emit_worker_event, is_worker_process, on_worker_event
+
+# Single background task that watches the state behind every SSE stream (import progress, OCR results, etc)
+# and fans out changes to the connected clients,
+# instead of each client re-querying the dbs in its own loop
+#
+# Topics are created when their first client subscribes and dropped when their last one leaves
+# Clients that fall behind skip straight to the latest state
+#
+# Sources are created, polled and closed on a single thread of their own,
+# since they query sqlite dbs that may be locked for a while (busy_timeout) and that shouldn't stall the event loop
+# (and a connection can only be used by the thread that opened it)
+
+TICK_SECONDS = 0.5
+
+
+class TopicSource(Protocol):
+    def poll(self) -> Any:
+        # Returns the new state, or None if nothing changed
+        ...
+
+    def close(self): ...
+
+
+class _Topic:
+    def __init__(self, source: TopicSource):
+        self.source = source
+        self.state: Any = None
+        self.version = 0
+        self.changed = asyncio.Event()
+        self.num_subscribers = 0
+        self.closed = False
+
+
+_TOPICS: dict[Hashable, _Topic] = dict()
+
+_WAKE_EVENT: asyncio.Event | None = None
+_TASK: asyncio.Task | None = None
+_LOOP: asyncio.AbstractEventLoop | None = None
+_EXECUTOR: ThreadPoolExecutor | None = None
+
+
+async def subscribe(
+    key: Hashable,
+    create_source: Callable[[], TopicSource],
+) -> AsyncGenerator[Any, None]:
+    # Yields the topic's current state (once there is one) and then every new state
+    topic = _TOPICS.get(key)
+    is_new = False
+    if topic is None:
+        source = await _in_thread(create_source)
+
+        # Another client may have created it in the meantime
+        topic = _TOPICS.get(key)
+        if topic is None:
+            topic = _TOPICS[key] = _Topic(source)
+            is_new = True
+        else:
+            await _in_thread(source.close)
+
+    topic.num_subscribers += 1
+    _ensure_task()
+
+    try:
+        if is_new:
+            await _poll(topic)
+
+        version = 0
+        while True:
+            if topic.version != version:
+                version = topic.version
+                yield topic.state
+                continue
+
+            await topic.changed.wait()
+    finally:
+        topic.num_subscribers -= 1
+        if topic.num_subscribers == 0 and _TOPICS.get(key) is topic:
+            del _TOPICS[key]
+            topic.closed = True
+            _get_executor().submit(topic.source.close)
+
+
+def notify_sse_hub():
+    # Poll now instead of waiting for the next tick
+    # Safe to call from any thread, and from worker processes (passed on to the process that started them)
+    if is_worker_process():
+        emit_worker_event("notify_sse_hub")
+        return
+
+    if not _WAKE_EVENT or not _LOOP:
+        return
+
+    try:
+        _LOOP.call_soon_threadsafe(_WAKE_EVENT.set)
+    except RuntimeError:
+        # Loop is closed
+        pass
+
+
+def _ensure_task():
+    global _WAKE_EVENT, _TASK, _LOOP
+
+    if _WAKE_EVENT is None:
+        _WAKE_EVENT = asyncio.Event()
+        _LOOP = asyncio.get_running_loop()
+
+    if _TASK is None or _TASK.done():
+        _TASK = asyncio.create_task(_run())
+
+
+async def _run():
+    assert _WAKE_EVENT
+
+    while _TOPICS:
+        try:
+            await asyncio.wait_for(_WAKE_EVENT.wait(), TICK_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+        _WAKE_EVENT.clear()
+
+        for topic in list(_TOPICS.values()):
+            await _poll(topic)
+
+
+async def _poll(topic: _Topic):
+    def poll():
+        # Closed while waiting for the thread
+        if topic.closed:
+            return None
+
+        return topic.source.poll()
+
+    try:
+        state = await _in_thread(poll)
+    except:
+        traceback.print_exc()
+        return
+
+    if state is None or topic.closed:
+        return
+
+    topic.state = state
+    topic.version += 1
+
+    # Wake up everyone waiting on the old event and give the next change a fresh one
+    topic.changed.set()
+    topic.changed = asyncio.Event()
+
+
+async def _in_thread(fn: Callable[[], Any]) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), fn)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(1, thread_name_prefix="sse_hub")
+
+    return _EXECUTOR
+
+
+on_worker_event("job_progress", lambda event: notify_sse_hub())
+on_worker_event("notify_sse_hub", lambda event: notify_sse_hub())
@@ -1,5 +1,6 @@
 import io
 import re
+import shutil
 import time
 import traceback
 from pathlib import Path
@@ -15,11 +16,20 @@ from yarl import URL
 from .config import Config
 from .db.chapter_db import load_chapter_db, update_chapter
 from .db.reader_db import ReaderDb, load_reader_db
-from .job_utils import JobManager, start_job_worker
+from .job_utils import (
+    PRIORITY_INTERACTIVE,
+    JobManager,
+    JobRetention,
+    start_job_worker,
+)
+from .ocr import prefetch_ocr
 from .paths import DATA_DIR, LOG_DIR
 
 IMPORT_JOB_TYPE = "import"
 
+# Chapters are downloaded here first and only moved into the series folder once they're complete
+_STAGING_DIR = DATA_DIR / "import_staging"
+
 _WORKER_SESSION: CachedSession = None  # type: ignore
 
 # time requested, bytes
@@ -39,7 +49,10 @@ def start_import_job_worker(cfg: Config):
         cfg,
         IMPORT_JOB_TYPE,
         _process_all_jobs,
-        batch_size=1,
+        num_workers=cfg.num_import_workers,
+        # Keep the results around for the progress page
+        retention=JobRetention(max_age_seconds=86400, max_rows=1000),
+        job_timeout=cfg.import_job_timeout_seconds,
     )
 
 
@@ -66,7 +79,8 @@ def insert_import_job(
     _LOGGER.info(f"Inserting import job {id} {job}")
 
     jobber = JobManager(db, IMPORT_JOB_TYPE)
-    jobber.insert(id, job)
+    # Someone's watching the progress page, and retries are safe since each attempt starts from an empty staging folder
+    jobber.insert(id, job, priority=PRIORITY_INTERACTIVE)
     db.commit()
 
     return id
@@ -95,18 +109,19 @@ def _process_all_jobs(cfg: Config, job_ids: list[str]):
             _LOGGER.info(
                 f"Done with import job {id} with {len(result['done'])} downloaded and {len(result['ignored'])} ignored"
             )
+
+            jobber.set_result(id, result)
+            jobber.db.commit()
         except:
-            # Delete job on error
+            # Retried after a backoff, or marked as failed if it's out of attempts
             traceback.print_exc()
+            shutil.rmtree(_STAGING_DIR / id, ignore_errors=True)
 
-            jobber.delete(id)
+            jobber.fail(id, dict(error=traceback.format_exc()))
             reader_db.commit()
 
             _LOGGER.exception(f"Failed import job {id}")
 
-        jobber.set_result(id, result)
-        jobber.db.commit()
-
 
 def _process_job(
     cfg: Config,
@@ -119,8 +134,11 @@ def _process_job(
     chap_dir = Path(job["chap_dir"])
     if chap_dir.exists():
         raise Exception()
-    else:
-        chap_dir.mkdir()
+
+    # Left over from an attempt that was killed (eg timed out)
+    staging_dir = _STAGING_DIR / job_id
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True)
 
     url_patt = None
     if job["patt"]:
@@ -133,8 +151,7 @@ def _process_job(
         ignored=[],
         phase="scanning",
     )
-    jobber.update_progress(job_id, progress)
-    jobber.db.commit()
+    jobber.report_progress(job_id, progress)
 
     history: RequestHistory = []
 
@@ -210,11 +227,11 @@ def _process_job(
     progress["phase"] = "downloading"
     progress["total"] = len(maybe_images) + len(to_ignore)
     progress["ignored"] = to_ignore
-    jobber.update_progress(job_id, progress)
-    jobber.db.commit()
+    jobber.report_progress(job_id, progress)
 
     rem_bytes = cfg.max_chapter_size_bytes
     idx_name = 1
+    fp_pages = []
 
     for image_or_url in maybe_images:
         # Check if we hit resource caps
@@ -223,8 +240,7 @@ def _process_job(
         if over_image_cap or over_size_cap:
             url = image_or_url["src"]
             progress["ignored"].append(url)
-            jobber.update_progress(job_id, progress)
-            jobber.db.commit()
+            jobber.report_progress(job_id, progress)
             continue
 
         # Download Image if we haven't already
@@ -242,8 +258,7 @@ def _process_job(
 
             if not result["success"]:
                 progress["ignored"].append(image_or_url["src"])
-                jobber.update_progress(job_id, progress)
-                jobber.db.commit()
+                jobber.report_progress(job_id, progress)
                 continue
 
             im: Image.Image = result["im"]
@@ -259,24 +274,29 @@ def _process_job(
         matches_height = im.size[1] >= job["min_height"]
         if not matches_width or not matches_height:
             progress["ignored"].append(url)
-            jobber.update_progress(job_id, progress)
-            jobber.db.commit()
+            jobber.report_progress(job_id, progress)
             continue
 
         # Save image
-        fp_out = chap_dir / f"{idx_name:03}.png"
+        fp_out = staging_dir / f"{idx_name:03}.png"
         im.save(fp_out)
+        fp_pages.append(chap_dir / fp_out.name)
 
         idx_name += 1
         rem_bytes -= size_bytes
 
         progress["done"].append(url)
-        jobber.update_progress(job_id, progress)
-        jobber.db.commit()
+        jobber.report_progress(job_id, progress)
+
+    if chap_dir.exists():
+        raise Exception()
+    shutil.move(staging_dir, chap_dir)
 
     db = load_chapter_db(chap_dir)
     update_chapter(db, name=job["chap_name"])
 
+    prefetch_ocr(cfg, fp_pages)
+
     return progress
 
 
@@ -0,0 +1,99 @@
+import asyncio
+import copy
+import multiprocessing
+import os
+import threading
+import traceback
+from multiprocessing.queues import Queue
+from typing import Callable
+
+# Lightweight channel for job worker processes to report things (model loads, etc)
+# back to the process that started them, without going through the reader db
+
+WorkerEventHandler = Callable[[dict], None]
+
+# Set in worker processes
+_CHILD_QUEUE: Queue | None = None
+_CHILD_LABELS: dict = dict()
+
+# Set in the process that owns the workers
+_PARENT_QUEUE: Queue | None = None
+
+_HANDLERS: dict[str, list[WorkerEventHandler]] = dict()
+
+
+def emit_worker_event(type: str, **data):
+    event = dict(
+        type=type,
+        pid=os.getpid(),
+        **_CHILD_LABELS,
+    )
+    event.update(data)
+
+    if _CHILD_QUEUE is None:
+        # Not running in a worker process (eg benchmark scripts)
+        _dispatch(event)
+    else:
+        # Copy because the queue pickles in a background thread
+        # and the caller may keep modifying the data (eg appending to progress lists)
+        _CHILD_QUEUE.put(copy.deepcopy(event))
+
+
+def is_worker_process() -> bool:
+    return _CHILD_QUEUE is not None
+
+
+def on_worker_event(type: str, fn: WorkerEventHandler):
+    # Handlers are called on the parent's event loop thread
+    _HANDLERS.setdefault(type, []).append(fn)
+
+
+def get_worker_event_queue() -> Queue:
+    # Must be called from the event loop that should receive the events
+    global _PARENT_QUEUE
+
+    if _PARENT_QUEUE is None:
+        loop = asyncio.get_running_loop()
+
+        _PARENT_QUEUE = multiprocessing.Queue()
+        threading.Thread(
+            target=_listen,
+            args=(_PARENT_QUEUE, loop),
+            daemon=True,
+        ).start()
+
+    return _PARENT_QUEUE
+
+
+def init_worker_process(
+    queue: Queue,
+    labels: dict,
+    initializer: Callable | None,
+    initargs: tuple,
+):
+    # ProcessPoolExecutor initializer for job workers
+    global _CHILD_QUEUE, _CHILD_LABELS
+    _CHILD_QUEUE = queue
+    _CHILD_LABELS = labels
+
+    if initializer:
+        initializer(*initargs)
+
+
+def _listen(queue: Queue, loop: asyncio.AbstractEventLoop):
+    while True:
+        event = queue.get()
+
+        try:
+            loop.call_soon_threadsafe(_dispatch, event)
+        except RuntimeError:
+            # Loop is closed
+            return
+
+
+def _dispatch(event: dict):
+    for fn in _HANDLERS.get(event["type"], []):
+        try:
+            fn(event)
+        except:
+            traceback.print_exc()
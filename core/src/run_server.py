@@ -7,15 +7,17 @@ from fastapi import FastAPI
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.inmemory import InMemoryBackend
 from lib.config import Config
-from lib.db.reader_db import clear_jobs, load_reader_db
-from lib.job_utils import start_job_purge_task
-from lib.llm.llm_worker import start_llm_job_worker
+from lib.job_utils import set_job_poll_interval
+from lib.job_workers import start_job_workers
 from lib.middleware import ErrorLog, log_http_exceptions
 from lib.nlp import start_nlp_pool
-from lib.ocr import start_ocr_job_worker
-from lib.proxy.proxy import start_proxy_job_worker
-from lib.routers import dictionary_router, llm_router, ocr_router, series_router
-from lib.url_import import start_import_job_worker
+from lib.routers import (
+    dictionary_router,
+    llm_router,
+    metrics_router,
+    ocr_router,
+    series_router,
+)
 
 # web gui doesn't support custom config so just hard code the config here too
 CONFIG_FILE = Path(__file__).parent.parent.parent / "config.toml"
@@ -39,13 +41,11 @@ async def _lifespan(app: FastAPI):
     app.state.kkma_pool = start_nlp_pool()
 
     # Start job workers
-    clear_jobs(load_reader_db())
-    start_job_purge_task()
-
-    start_ocr_job_worker(cfg)
-    start_llm_job_worker(cfg)
-    start_import_job_worker(cfg)
-    start_proxy_job_worker(cfg)
+    # (unless they're running in a separate process, see scripts/run_workers.py)
+    if cfg.run_job_workers and not args.no_workers:
+        start_job_workers(cfg)
+    else:
+        set_job_poll_interval(cfg.job_poll_seconds)
 
     yield
 
@@ -59,6 +59,7 @@ app.include_router(series_router.router)
 app.include_router(dictionary_router.router)
 app.include_router(ocr_router.router)
 app.include_router(llm_router.router)
+app.include_router(metrics_router.router)
 
 
 def _parse_args():
@@ -73,6 +74,17 @@ def _parse_args():
         action="store_true",
         help="Enable hot-reloading",
     )
+    parser.add_argument(
+        "--no-workers",
+        action="store_true",
+        help="Don't start the job workers in the web server (run scripts/run_workers.py instead)",
+    )
+    parser.add_argument(
+        "--http-workers",
+        type=int,
+        default=1,
+        help="Number of web server processes. Requires --no-workers (or run_job_workers = false) if more than 1",
+    )
 
     return parser.parse_args()
 
@@ -82,9 +94,14 @@ if __name__ == "__main__":
     # cfg = Config.load_toml(args.config_file)
     cfg = Config.load_toml(CONFIG_FILE)
 
+    # Otherwise every process would start its own copy of every job worker
+    if args.http_workers > 1 and cfg.run_job_workers and not args.no_workers:
+        raise SystemExit("--http-workers > 1 requires --no-workers")
+
     uvicorn.run(
         "run_server:app",
         reload=args.debug,
         host="0.0.0.0",
         port=cfg.api_port,
+        workers=args.http_workers,
     )
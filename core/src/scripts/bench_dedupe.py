@@ -0,0 +1,181 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import argparse
+import random
+import time
+
+from comic_ocr.lib.label_utils import OcrMatch, stitch_lines
+from lib.ocr_dedupe import _area, _get_overlap, dedupe_matches
+
+DESCRIPTION = """
+Benchmarks the removal of duplicate OCR matches (see ocr_dedupe_min_overlap in config_example.toml)
+on synthetic pages packed with text, against comparing every pair of matches
+
+For example:
+
+    python core/src/scripts/bench_dedupe.py --heights 10000 50000 100000
+""".strip()
+
+WORD_HEIGHT = 24
+LINE_SPACING = 40
+
+
+def run(args):
+    rng = random.Random(args.seed)
+
+    print(
+        f"{'height':>8} {'matches':>8} {'kept':>8} {'grid':>10} {'pairwise':>10} {'stitch (raw)':>14} {'stitch (deduped)':>18}"
+    )
+
+    for height in args.heights:
+        matches, windows = make_page(
+            rng, height, args.width, args.window_size, args.margin
+        )
+
+        grid_time, kept = _time(
+            lambda: dedupe_matches(matches, windows, args.min_overlap)
+        )
+
+        # Too slow to bother with on the biggest pages
+        if len(matches) <= args.max_pairwise:
+            pairwise_time, expected = _time(
+                lambda: dedupe_pairwise(matches, windows, args.min_overlap)
+            )
+            assert kept == expected, "grid and pairwise results differ"
+            pairwise = f"{pairwise_time:.3f}s"
+        else:
+            pairwise = "-"
+
+        if args.stitch:
+            stitch_raw = f"{_time(lambda: stitch_lines(matches))[0]:.3f}s"
+            stitch_deduped = f"{_time(lambda: stitch_lines(kept))[0]:.3f}s"
+        else:
+            stitch_raw = stitch_deduped = "-"
+
+        print(
+            f"{height:>8} {len(matches):>8} {len(kept):>8} {grid_time:>9.3f}s {pairwise:>10} {stitch_raw:>14} {stitch_deduped:>18}"
+        )
+
+
+def make_page(
+    rng: random.Random,
+    height: int,
+    width: int,
+    window_size: int,
+    margin: int,
+) -> tuple[list[OcrMatch], list[int]]:
+    # Lines of words all the way down, OCR'd in windows that overlap by margin px
+    # Words in the overlap are found by both windows, slightly offset and sometimes cut off by the window's edge
+    # Returns the matches and the index of the window that each one came from
+    words: list[tuple[int, int, int, int]] = []
+    for y in range(0, height - WORD_HEIGHT, LINE_SPACING):
+        x = rng.randint(0, 20)
+        while True:
+            w = rng.randint(20, 120)
+            if x + w > width:
+                break
+
+            words.append((y, x, y + WORD_HEIGHT, x + w))
+            x += w + rng.randint(10, 30)
+
+    matches: list[OcrMatch] = []
+    windows: list[int] = []
+    step = window_size - margin
+    for idx, top in enumerate(range(0, height, step)):
+        bottom = top + window_size
+
+        for y1, x1, y2, x2 in words:
+            if y2 <= top or y1 >= bottom:
+                continue
+
+            # Cut off by the window
+            cy1 = max(y1, top)
+            cy2 = min(y2, bottom)
+            if cy2 - cy1 < WORD_HEIGHT // 2:
+                continue
+
+            bbox = tuple(v + rng.randint(-2, 2) for v in [cy1, x1, cy2, x2])
+            matches.append(
+                OcrMatch(bbox, rng.random(), f"{y1}-{x1}")  # type: ignore
+            )
+            windows.append(idx)
+
+        if bottom >= height:
+            break
+
+    return matches, windows
+
+
+def dedupe_pairwise(
+    matches: list[OcrMatch],
+    windows: list[int],
+    min_overlap: float,
+) -> list[OcrMatch]:
+    # Same as dedupe_matches() but compares each match with every one kept so far
+    order = sorted(
+        range(len(matches)),
+        key=lambda idx: (_area(matches[idx].bbox), matches[idx].confidence),
+        reverse=True,
+    )
+
+    kept: list[int] = []
+    for idx in order:
+        if any(
+            _get_overlap(matches[idx].bbox, matches[other].bbox) >= min_overlap
+            for other in kept
+            if windows[other] != windows[idx]
+        ):
+            continue
+
+        kept.append(idx)
+
+    kept.sort()
+    return [matches[idx] for idx in kept]
+
+
+def _time(fn) -> tuple[float, list]:
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--heights",
+        type=int,
+        nargs="+",
+        default=[5_000, 20_000, 50_000],
+        help="Page heights (in px) to benchmark",
+    )
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--window-size", type=int, default=1024)
+    parser.add_argument("--margin", type=int, default=100)
+    parser.add_argument("--min-overlap", type=float, default=0.7)
+    parser.add_argument(
+        "--max-pairwise",
+        type=int,
+        default=5_000,
+        help="Skip the pairwise comparison for pages with more matches than this",
+    )
+    parser.add_argument(
+        "--stitch",
+        action="store_true",
+        help="Also time stitch_lines() on the matches before and after removing the duplicates",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+
+    run(args)
@@ -0,0 +1,354 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import argparse
+import dataclasses
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import redirect_stdout
+from itertools import chain, product
+from typing import Any, Callable
+
+from lib import ocr
+from lib.config import Config
+from lib.constants import SUPPORTED_IMAGE_EXTENSIONS
+from lib.ocr_batch import PaddingStats
+from PIL import Image, ImageDraw, ImageFont
+
+CONFIG_FILE = Path(__file__).parent.parent.parent.parent / "config.toml"
+
+DESCRIPTION = """
+Benchmarks the OCR pipeline on a folder of page images and / or synthetic pages,
+with the models and settings in your config.toml
+
+Reports pages/sec and windows/sec, and how the time splits across decoding the images,
+cropping the windows, skipping blank windows, detection, recognition, removing duplicate matches and stitching,
+and how much of the recognizer's input was word crops rather than padding (see ocr_reco_bucket_size),
+for every combination of the given det_input_size / margin_size / max_ocr_width values
+
+The results are printed (or written to --output) as JSON so that runs can be compared across changes. For example:
+
+    python core/src/scripts/bench_ocr.py --fixtures data/series/wowow/001 --synthetic 5 --margin-sizes 50 100 --output before.json
+""".strip()
+
+# Korean text for the synthetic pages, if --font can render it
+SYNTHETIC_TEXT = "가나다라마바사아자차카타파하 안녕하세요 감사합니다 그래서 어떻게 됐어 진짜로 말도 안돼"
+
+# Parts of the pipeline that are timed
+# (whatever isn't covered, eg converting the model output to matches, is reported as "other")
+STAGES = [
+    "decode",
+    "crop",
+    "blank_check",
+    "detection",
+    "recognition",
+    "dedupe",
+    "stitch_lines",
+    "stitch_blocks",
+]
+
+# Seconds spent in each stage, and other counts, since they were last cleared
+_TIMINGS: dict[str, float] = defaultdict(float)
+_COUNTS: dict[str, int] = defaultdict(int)
+
+
+def run(args, cfg: Config) -> dict:
+    fp_images = _get_fixture_images(args.fixtures) if args.fixtures else []
+
+    if args.synthetic:
+        synthetic_dir = Path(tempfile.mkdtemp())
+        fp_images += make_synthetic_pages(
+            synthetic_dir,
+            args.synthetic,
+            args.synthetic_width,
+            args.synthetic_height,
+            args.font,
+            args.seed,
+        )
+
+    if not fp_images:
+        raise SystemExit("No images to benchmark (pass --fixtures and / or --synthetic)")
+
+    predictor = ocr.load_ocr_predictor(cfg, args.backend)
+    _instrument(predictor)
+
+    runs = []
+    for det_input_size, margin_size, max_ocr_width in product(
+        args.det_input_sizes or [cfg.det_input_size],
+        args.margin_sizes or [cfg.margin_size],
+        args.max_ocr_widths or [cfg.max_ocr_width],
+    ):
+        run_cfg = dataclasses.replace(
+            cfg,
+            det_input_size=det_input_size,
+            margin_size=margin_size,
+            max_ocr_width=max_ocr_width,
+        )
+
+        # Warm up the models (and the disk cache) before timing anything
+        for fp in fp_images[: args.warmup]:
+            bench_pages(run_cfg, predictor, [fp])
+
+        _TIMINGS.clear()
+        _COUNTS.clear()
+
+        result = dict(
+            det_input_size=det_input_size,
+            margin_size=margin_size,
+            max_ocr_width=max_ocr_width,
+            **bench_pages(run_cfg, predictor, fp_images),
+        )
+
+        runs.append(result)
+        print(
+            f"det_input_size={det_input_size} margin_size={margin_size} max_ocr_width={max_ocr_width}:"
+            f" {result['pages_per_second']:.2f} pages/s, {result['windows_per_second']:.2f} windows/s",
+            file=sys.stderr,
+        )
+
+    return dict(
+        environment=dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            backend=args.backend or cfg.ocr_backend,
+            det_arch=cfg.det_arch,
+            reco_arch=cfg.reco_arch,
+            use_gpu_for_ocr=cfg.use_gpu_for_ocr,
+            ocr_batch_size=cfg.ocr_batch_size,
+            ocr_reco_bucket_size=cfg.ocr_reco_bucket_size,
+            reco_narrow_inputs=getattr(predictor.reco_predictor, "narrow", False),
+        ),
+        images=[str(fp) for fp in fp_images],
+        runs=runs,
+    )
+
+
+def bench_pages(cfg: Config, predictor: Any, fp_images: list[Path]) -> dict:
+    # OCRs the pages the same way the job worker does (batching all of their windows together)
+    start = time.perf_counter()
+
+    # Only there if ocr_reco_bucket_size is set
+    padding_stats = getattr(predictor.reco_predictor, "padding_stats", None)
+    if padding_stats is not None:
+        padding_stats = predictor.reco_predictor.padding_stats = PaddingStats()
+
+    pages = []
+    for idx, fp in enumerate(fp_images):
+        decode_start = time.perf_counter()
+
+        job = dict(fp_image=str(fp), chap_dir=str(fp.parent))
+        page = ocr._load_page(cfg, str(idx), job)
+
+        # Otherwise it's only decoded when the first window is cropped
+        page.im.load()
+
+        _TIMINGS["decode"] += time.perf_counter() - decode_start
+        pages.append(page)
+
+    for _ in ocr._ocr_pages(cfg, predictor, pages):
+        pass
+
+    num_blocks = 0
+    for page in pages:
+        num_blocks += len(ocr._stitch_page(cfg, page))
+
+    total = time.perf_counter() - start
+    num_windows = sum(len(page.windows) for page in pages)
+
+    stages = {stage: _TIMINGS.get(stage, 0.0) for stage in STAGES}
+    stages["other"] = max(total - sum(stages.values()), 0)
+
+    return dict(
+        pages=len(pages),
+        windows=num_windows,
+        blank_windows=_COUNTS.get("blank_windows", 0),
+        matches=sum(len(page.matches) for page in pages),
+        blocks=num_blocks,
+        seconds=total,
+        pages_per_second=len(pages) / total,
+        windows_per_second=num_windows / total,
+        stages=stages,
+        word_crops=padding_stats.crops if padding_stats is not None else None,
+        # Fraction of the recognizer's input that was word crops, as batched and as it would be in the original order
+        padding_efficiency=(
+            padding_stats.efficiency if padding_stats is not None else None
+        ),
+        unsorted_padding_efficiency=(
+            padding_stats.unsorted_efficiency if padding_stats is not None else None
+        ),
+    )
+
+
+def make_synthetic_pages(
+    folder: Path,
+    num_pages: int,
+    width: int,
+    height: int,
+    fp_font: Path | None,
+    seed: int,
+) -> list[Path]:
+    # Webtoon-like strips: speech bubbles with a few lines of text, separated by empty gutters
+    rng = random.Random(seed)
+    font = (
+        ImageFont.truetype(str(fp_font), 28) if fp_font else ImageFont.load_default(28)
+    )
+    text = SYNTHETIC_TEXT if fp_font else "the quick brown fox jumps over the lazy dog"
+
+    fp_images = []
+    for idx in range(num_pages):
+        im = Image.new("RGB", (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(im)
+
+        y = rng.randint(50, 400)
+        while y < height - 400:
+            # Panel
+            panel_height = rng.randint(300, 900)
+            shade = rng.randint(150, 230)
+            draw.rectangle(
+                (20, y, width - 20, y + panel_height),
+                fill=(shade, shade - 20, shade - 40),
+            )
+
+            # Bubble
+            bx = rng.randint(40, max(width - 440, 41))
+            by = y + rng.randint(20, max(panel_height - 220, 21))
+            draw.ellipse((bx, by, bx + 400, by + 200), fill=(255, 255, 255), outline=0)
+
+            for line in range(rng.randint(1, 3)):
+                start = rng.randint(0, len(text) - 10)
+                draw.text(
+                    (bx + 50, by + 40 + line * 40),
+                    text[start : start + rng.randint(5, 10)],
+                    fill=(0, 0, 0),
+                    font=font,
+                )
+
+            # Gutter
+            y += panel_height + rng.randint(200, 1500)
+
+        fp = folder / f"synthetic_{idx:03}.jpg"
+        im.save(fp, quality=90)
+        fp_images.append(fp)
+
+    return fp_images
+
+
+def _instrument(predictor: Any):
+    # Times each stage by wrapping the functions that the OCR module calls
+    ocr.dedupe_matches = _timed(ocr.dedupe_matches, "dedupe")
+    ocr.stitch_lines = _timed(ocr.stitch_lines, "stitch_lines")
+    ocr.stitch_blocks = _timed(ocr.stitch_blocks, "stitch_blocks")
+    ocr.record_window = _timed(ocr.record_window, "crop")
+
+    find_blank_windows = _timed(ocr.find_blank_windows, "blank_check")
+
+    def count_blank_windows(*args, **kwargs):
+        blank = find_blank_windows(*args, **kwargs)
+        _COUNTS["blank_windows"] += sum(blank)
+        return blank
+
+    ocr.find_blank_windows = count_blank_windows
+
+    # The detector / recognizer run inside the predictor's call
+    _time_calls(predictor.det_predictor, "detection")
+    _time_calls(predictor.reco_predictor, "recognition")
+
+
+def _timed(fn: Callable, stage: str) -> Callable:
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _TIMINGS[stage] += time.perf_counter() - start
+
+    return wrapper
+
+
+def _time_calls(obj: Any, stage: str):
+    # Swaps in a subclass since __call__ is looked up on the class (and torch modules don't allow replacing submodules)
+    class Timed(obj.__class__):
+        def __call__(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().__call__(*args, **kwargs)
+            finally:
+                _TIMINGS[stage] += time.perf_counter() - start
+
+    obj.__class__ = Timed
+
+
+def _get_fixture_images(folder: Path) -> list[Path]:
+    globs = [folder.glob(f"*{ext}") for ext in SUPPORTED_IMAGE_EXTENSIONS]
+    return sorted(chain(*globs))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--fixtures",
+        type=Path,
+        help="Folder of page images to benchmark",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="Number of synthetic pages to generate and benchmark",
+    )
+    parser.add_argument("--synthetic-width", type=int, default=800)
+    parser.add_argument("--synthetic-height", type=int, default=12_000)
+    parser.add_argument(
+        "--font",
+        type=Path,
+        help="Font for the synthetic pages' text, eg a Korean .ttf (otherwise it's English text in Pillow's default font)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--det-input-sizes", type=int, nargs="+")
+    parser.add_argument("--margin-sizes", type=int, nargs="+")
+    parser.add_argument("--max-ocr-widths", type=int, nargs="+")
+    parser.add_argument(
+        "--backend",
+        choices=["torch", "onnx", "onnx_int8"],
+        help="OCR backend (default ocr_backend from config.toml)",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=1,
+        help="Number of pages to OCR before timing each combination of settings",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="Write the results to this file instead of stdout",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    cfg = Config.load_toml(CONFIG_FILE)
+
+    # Keep stdout for the results
+    with redirect_stdout(sys.stderr):
+        results = run(args, cfg)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
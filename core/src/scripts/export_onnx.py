@@ -0,0 +1,184 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import argparse
+import json
+from itertools import chain
+
+import torch
+from comic_ocr.lib.label_utils import OcrMatch
+from doctr.models.utils import export_model_to_onnx
+from Levenshtein import ratio
+from lib.config import Config
+from lib.constants import SUPPORTED_IMAGE_EXTENSIONS
+from lib.ocr import (
+    get_onnx_model_paths,
+    load_ocr_predictor,
+    load_torch_ocr_models,
+    ocr_file,
+)
+
+CONFIG_FILE = Path(__file__).parent.parent.parent.parent / "config.toml"
+
+DESCRIPTION = """
+Exports the OCR models in your config.toml (det_arch / det_weights, reco_arch / reco_weights) to ONNX
+for use with ocr_backend = "onnx" (or "onnx_int8")
+
+If a folder of images is passed with --fixtures, each image is OCR'd by both the PyTorch and the exported models
+and the results are compared. For example:
+
+    python core/src/scripts/export_onnx.py --int8 --fixtures data/series/wowow/001
+
+Exits with an error if the text similarity is under --min-similarity
+""".strip()
+
+
+def run(args, cfg: Config):
+    Path(cfg.ocr_onnx_folder).mkdir(parents=True, exist_ok=True)
+
+    export(cfg)
+    backends = ["onnx"]
+
+    if args.int8:
+        quantize(cfg)
+        backends.append("onnx_int8")
+
+    if not args.fixtures:
+        return
+
+    fp_images = sorted(
+        chain(*[args.fixtures.glob(f"*{ext}") for ext in SUPPORTED_IMAGE_EXTENSIONS])
+    )
+    if not fp_images:
+        raise SystemExit(f"No images found in {args.fixtures}")
+
+    reference = load_ocr_predictor(cfg, "torch")
+    expected = {fp: ocr_file(cfg, reference, fp) for fp in fp_images}
+
+    failed = False
+    for backend in backends:
+        predictor = load_ocr_predictor(cfg, backend)
+        actual = {fp: ocr_file(cfg, predictor, fp) for fp in fp_images}
+
+        report = compare(expected, actual)
+        print(backend, json.dumps(report, indent=2))
+
+        if report["text_similarity"] < args.min_similarity:
+            print(f"{backend} text similarity is under {args.min_similarity}")
+            failed = True
+
+    if failed:
+        raise SystemExit(1)
+
+
+def export(cfg: Config):
+    det_model, reco_model = load_torch_ocr_models(cfg, exportable=True)
+    fp_det, fp_reco = get_onnx_model_paths(cfg)
+
+    for model, fp in [(det_model, fp_det), (reco_model, fp_reco)]:
+        model.eval()
+
+        dummy_input = torch.rand((1, *model.cfg["input_shape"]), dtype=torch.float32)
+
+        # (the .onnx extension is added by doctr)
+        export_model_to_onnx(model, str(fp.with_suffix("")), dummy_input)
+        print(f"Exported {fp}")
+
+
+def quantize(cfg: Config):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    for fp_in, fp_out in zip(get_onnx_model_paths(cfg), get_onnx_model_paths(cfg, int8=True)):
+        quantize_dynamic(fp_in, fp_out, weight_type=QuantType.QInt8)
+        print(f"Exported {fp_out}")
+
+
+def compare(
+    expected: dict[Path, list[OcrMatch]],
+    actual: dict[Path, list[OcrMatch]],
+    min_iou=0.5,
+) -> dict:
+    # Pair up each reference match with the exported model's most overlapping one
+    num_expected = 0
+    num_actual = 0
+    num_paired = 0
+    num_exact = 0
+    similarity = 0.0
+
+    for fp, ms_expected in expected.items():
+        ms_actual = list(actual[fp])
+
+        num_expected += len(ms_expected)
+        num_actual += len(ms_actual)
+
+        for m in ms_expected:
+            best = max(ms_actual, key=lambda x: _iou(m.bbox, x.bbox), default=None)
+            if best is None or _iou(m.bbox, best.bbox) < min_iou:
+                continue
+
+            ms_actual.remove(best)
+
+            num_paired += 1
+            num_exact += m.value == best.value
+            similarity += ratio(m.value, best.value)
+
+    return dict(
+        images=len(expected),
+        # Reference boxes that the exported model also found
+        box_recall=num_paired / max(num_expected, 1),
+        # Exported model's boxes that the reference also found
+        box_precision=num_paired / max(num_actual, 1),
+        # Over the paired boxes
+        exact_text_match=num_exact / max(num_paired, 1),
+        # Unpaired reference boxes count as 0
+        text_similarity=similarity / max(num_expected, 1),
+    )
+
+
+def _iou(a: tuple, b: tuple) -> float:
+    ay1, ax1, ay2, ax2 = a
+    by1, bx1, by2, bx2 = b
+
+    h = min(ay2, by2) - max(ay1, by1)
+    w = min(ax2, bx2) - max(ax1, bx1)
+    if h <= 0 or w <= 0:
+        return 0
+
+    intersection = h * w
+    union = (ay2 - ay1) * (ax2 - ax1) + (by2 - by1) * (bx2 - bx1) - intersection
+    return intersection / union
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Also export int8-quantized copies of the models (for ocr_backend = onnx_int8)",
+    )
+    parser.add_argument(
+        "--fixtures",
+        type=Path,
+        help="Folder of images to compare the exported models against the PyTorch ones on",
+    )
+    parser.add_argument(
+        "--min-similarity",
+        type=float,
+        default=0.95,
+        help="Minimum text similarity (0-1) for the comparison to pass",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    cfg = Config.load_toml(CONFIG_FILE)
+
+    run(args, cfg)
@@ -0,0 +1,77 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import argparse
+import asyncio
+
+import uvicorn
+from fastapi import FastAPI
+from lib.config import Config
+from lib.job_utils import set_job_poll_interval, start_progress_flush_task
+from lib.job_workers import JOB_WORKERS, start_job_workers
+from lib.routers import metrics_router
+
+CONFIG_FILE = Path(__file__).parent.parent.parent.parent / "config.toml"
+
+DESCRIPTION = """
+Runs the background job workers (OCR, LLM, chapter imports, proxied requests) outside of the web server
+
+Jobs are exchanged through the reader db in the data folder,
+so this must run on the same machine as the web server (SQLite's WAL mode doesn't work over network filesystems)
+(set run_job_workers = false in your config.toml or start the server with --no-workers)
+
+For example, to only run the OCR and LLM workers and serve their metrics on port 9495:
+
+    python core/src/scripts/run_workers.py --types ocr llm --metrics-port 9495
+""".strip()
+
+
+async def run(args, cfg: Config):
+    # The web server can't wake the workers up directly so check the db for new jobs more often
+    set_job_poll_interval(cfg.job_poll_seconds)
+
+    start_job_workers(cfg, args.types)
+
+    # Likewise the web server doesn't see the workers' progress updates so save them to the db every so often
+    start_progress_flush_task()
+
+    if args.metrics_port:
+        app = FastAPI()
+        app.include_router(metrics_router.router)
+
+        server = uvicorn.Server(
+            uvicorn.Config(app, host="0.0.0.0", port=args.metrics_port)
+        )
+        await server.serve()
+    else:
+        await asyncio.Event().wait()
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--types",
+        nargs="+",
+        choices=list(JOB_WORKERS.keys()),
+        help="Job types to run workers for (default all)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve /metrics for these workers on this port",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    cfg = Config.load_toml(CONFIG_FILE)
+
+    asyncio.run(run(args, cfg))